@@ -20,25 +20,16 @@ function getStoryMapFolder() {
   return folders.hasNext() ? folders.next() : DriveApp.createFolder(folderName);
 }
 
-function generateMap() {
+// profile: 'preview' (fast, small) while editing, 'print' for a full-quality map
+function generateMap(profile) {
+  profile = profile || 'preview';
   const doc = DocumentApp.getActiveDocument();
   const text = doc.getBody().getText(); 
-  const payload = {
-    content: text
-  };
+  const paragraphs = text.split('\n');
 
   const apiUrl = getApiUrl();
-  const response = UrlFetchApp.fetch(`${apiUrl}/generate_map`, {
-    method: 'post',
-    contentType: 'application/json',
-    payload: JSON.stringify(payload)
-  });
-
-
-  const data = JSON.parse(response.getContentText());
-
-  const pngBase64 = data.map_png_base64;
-  const conflicts = data.conflicts;
+  const response = fetchMapIncremental(apiUrl, doc.getId(), paragraphs, profile);
+  const { blob, conflicts } = readMapResponse(response);
   
   clearAllHighlights();
   PropertiesService.getScriptProperties().setProperty('hue', '-20');
@@ -47,12 +38,6 @@ function generateMap() {
   // let blob = response.getBlob();
   // blob.setContentType('image/png');
 
-  const blob = Utilities.newBlob(
-    Utilities.base64Decode(pngBase64),
-    'image/png',
-    'map.png'
-  );
-
   // const folder = getStoryMapFolder();
 
   // const existingFiles = folder.getFiles();
@@ -69,7 +54,7 @@ function generateMap() {
 
   const base64 = Utilities.base64Encode(blob.getBytes());
   return {
-    dataUrl: `data:image/png;base64,${base64}`,
+    dataUrl: `data:${blob.getContentType()};base64,${base64}`,
     // fileName: fileName,
     // folderUrl: folder.getUrl(),
     fileName: "test",
@@ -78,6 +63,144 @@ function generateMap() {
   };
 }
 
+// Identifies a whole version of the document, as DocumentSession.version()
+// does on the server (hex SHA-256 of the paragraphs joined by newlines).
+function documentVersion(paragraphs) {
+  return Utilities.computeDigest(Utilities.DigestAlgorithm.SHA_256, paragraphs.join('\n'), Utilities.Charset.UTF_8)
+    .map(b => ((b + 256) % 256).toString(16).padStart(2, '0'))
+    .join('');
+}
+
+function paragraphHashes(paragraphs) {
+  return paragraphs.map(p => Utilities.base64Encode(
+    Utilities.computeDigest(Utilities.DigestAlgorithm.MD5, p, Utilities.Charset.UTF_8)
+  ).slice(0, 12));
+}
+
+// Sends only the paragraphs that changed since the last map of this document,
+// with the version they apply to. The server answers 409 when it doesn't have
+// that version (e.g. after a restart, or when it applied edits whose result
+// we never saw), in which case the whole document is sent instead.
+function fetchMapIncremental(apiUrl, docId, paragraphs, profile) {
+  const props = PropertiesService.getDocumentProperties();
+  const hashes = paragraphHashes(paragraphs);
+  const stored = props.getProperty('paragraphHashes');
+  const storedVersion = props.getProperty('documentVersion');
+
+  let payload = { doc_id: docId, paragraphs: paragraphs, profile: profile };
+  if (stored && storedVersion) {
+    const previous = JSON.parse(stored);
+    let start = 0;
+    while (start < previous.length && start < hashes.length && previous[start] === hashes[start]) {
+      start++;
+    }
+    let suffix = 0;
+    while (suffix < previous.length - start && suffix < hashes.length - start &&
+           previous[previous.length - 1 - suffix] === hashes[hashes.length - 1 - suffix]) {
+      suffix++;
+    }
+    payload = {
+      doc_id: docId,
+      edits: [{
+        start: start,
+        end: previous.length - suffix,
+        paragraphs: paragraphs.slice(start, paragraphs.length - suffix)
+      }],
+      base_version: storedVersion,
+      paragraph_count: paragraphs.length,
+      profile: profile
+    };
+  }
+
+  // Maps are generated as background jobs on the server, so a long document
+  // doesn't run into UrlFetchApp's timeout; post() submits and waits for one.
+  const post = body => {
+    const submitted = UrlFetchApp.fetch(`${apiUrl}/jobs`, {
+      method: 'post',
+      contentType: 'application/json',
+      payload: JSON.stringify(body),
+      muteHttpExceptions: true
+    });
+    if (submitted.getResponseCode() !== 202) {
+      return submitted;
+    }
+    return pollJob(apiUrl, JSON.parse(submitted.getContentText()).job_id);
+  };
+
+  let response = post(payload);
+  if (response.getResponseCode() === 409) {
+    response = post({ doc_id: docId, paragraphs: paragraphs, profile: profile });
+  }
+  if (response.getResponseCode() === 422) {
+    // no places in the text yet, so there is no map to show
+    props.deleteProperty('paragraphHashes');
+    throw new Error(JSON.parse(response.getContentText()).error);
+  }
+  if (response.getResponseCode() !== 200) {
+    props.deleteProperty('paragraphHashes');
+    throw new Error(`Map generation failed (${response.getResponseCode()}): ${response.getContentText()}`);
+  }
+
+  try {
+    props.setProperty('paragraphHashes', JSON.stringify(hashes));
+    props.setProperty('documentVersion', documentVersion(paragraphs));
+  } catch (e) {
+    // too many paragraphs for a property value; fall back to full sends
+    props.deleteProperty('paragraphHashes');
+  }
+  return response;
+}
+
+const MAX_JOB_WAIT_MS = 4 * 60 * 1000;  // Apps Script stops at 6 minutes
+
+function pollJob(apiUrl, jobId) {
+  const started = Date.now();
+  let delay = 500;
+  while (Date.now() - started < MAX_JOB_WAIT_MS) {
+    const response = UrlFetchApp.fetch(`${apiUrl}/jobs/${jobId}`, {
+      // the raw image is about a third smaller than base64 inside JSON; PNG
+      // rather than WebP keeps the labels sharp and skips re-encoding
+      headers: { Accept: 'image/png, application/json;q=0.5' },
+      muteHttpExceptions: true
+    });
+    if (response.getResponseCode() !== 202) {
+      return response;
+    }
+    Utilities.sleep(delay);
+    delay = Math.min(delay * 2, 4000);
+  }
+  throw new Error('Map generation is taking too long, try again in a moment');
+}
+
+// The server sends the image itself with the conflicts in a header, or JSON
+// with a base64 PNG when the conflicts don't fit in a header.
+function readMapResponse(response) {
+  const headers = response.getHeaders();
+  const contentType = Object.keys(headers)
+    .filter(name => name.toLowerCase() === 'content-type')
+    .map(name => headers[name])[0] || '';
+
+  if (contentType.indexOf('image/') === 0) {
+    const conflictsHeader = Object.keys(headers)
+      .filter(name => name.toLowerCase() === 'x-story-map-conflicts')
+      .map(name => headers[name])[0];
+    const conflicts = conflictsHeader
+      ? JSON.parse(Utilities.newBlob(Utilities.base64Decode(conflictsHeader)).getDataAsString('UTF-8'))
+      : [];
+    const type = contentType.split(';')[0];
+    const blob = response.getBlob().setContentType(type).setName(type === 'image/webp' ? 'map.webp' : 'map.png');
+    return { blob: blob, conflicts: conflicts };
+  }
+
+  const data = JSON.parse(response.getContentText());
+  const blob = Utilities.newBlob(
+    Utilities.base64Decode(data.map_png_base64),
+    'image/png',
+    'map.png'
+  );
+  return { blob: blob, conflicts: data.conflicts };
+}
+
 function highlightConflictPairs(conflictPairs) {
   const body = DocumentApp.getActiveDocument().getBody();
 
@@ -1,36 +1,328 @@
 #This file is for running the backend for the Google Docs plug-in. For local testing, use main.py.
-from flask import Flask, request, jsonify
+from flask import Flask, abort, make_response, request, jsonify
 import base64
-from src.generator import generate_map
+import gzip
+import io
+import json
+import threading
+from functools import lru_cache
+from PIL import Image
+from src import config, layout_store, models
+from src.cache import get_result_cache
+from src.generator import document_travel_info, find_conflicts, generate_map, map_from_travel_info
+from src.jobs import JobQueue, QueueFull
+from src.sessions import SessionStore
+from src.terrain import get_render_profile
+from src.tracing import NO_TRACE, Trace
+try:
+    import zstandard
+except ImportError:  # gzip only
+    zstandard = None
 
 app = Flask(__name__)
+sessions = SessionStore()
+jobs = JobQueue()
+results = get_result_cache()
+
+IMAGE_TYPES = ["image/png", "image/webp"]
+CONFLICTS_HEADER = "X-Story-Map-Conflicts"
+TRACE_HEADER = "X-Story-Map-Trace"
+MAX_CONFLICTS_HEADER = 8192  # proxies (ngrok) reject much larger headers
+MIN_COMPRESS_SIZE = 1024
+
+def map_response(map_png, conflicts, trace=None):
+    """
+    Answers with the raw image when the client asks for one in its Accept
+    header (image/png or image/webp). The conflicts then go in the
+    X-Story-Map-Conflicts header as base64-encoded JSON, since header values
+    must be ASCII. Otherwise, or when the conflicts are too long for a header,
+    it answers JSON with the PNG in base64 as before. A trace is added as
+    "trace" in the JSON or the X-Story-Map-Trace header. A text without
+    places has no map, and gets a 422 with the conflicts.
+    """
+    if map_png is None:
+        body = {"error": "no places found in the text", "conflicts": conflicts}
+        if trace is not None:
+            body["trace"] = trace.to_dict()
+        return jsonify(body), 422
+
+    mimetype = request.accept_mimetypes.best_match(["application/json"] + IMAGE_TYPES)
+    if mimetype in IMAGE_TYPES:
+        header = base64.b64encode(json.dumps(conflicts).encode("utf-8")).decode("ascii")
+        if len(header) <= MAX_CONFLICTS_HEADER:
+            image = map_png if mimetype == "image/png" else to_webp(map_png)
+            response = make_response(image)
+            response.mimetype = mimetype
+            response.headers[CONFLICTS_HEADER] = header
+            if trace is not None:
+                response.headers[TRACE_HEADER] = base64.b64encode(trace.to_json().encode("utf-8")).decode("ascii")
+            response.vary.add("Accept")
+            return response
+
+    img_b64 = base64.b64encode(map_png).decode('utf-8')
+
+    body = {
+        "map_png_base64": img_b64,
+        "conflicts": conflicts
+    }
+    if trace is not None:
+        body["trace"] = trace.to_dict()
+    response = jsonify(body)
+    response.vary.add("Accept")
+    return response
+
+# A cached map is sent again as the same bytes, so its WebP is encoded once
+@lru_cache(maxsize=16)
+def to_webp(png):
+    buf = io.BytesIO()
+    Image.open(io.BytesIO(png)).save(buf, format="WEBP", quality=90, method=4)
+    return buf.getvalue()
+
+def resync_response(message):
+    return jsonify({"error": message, "resync": True}), 409
+
+def wants_trace(data):
+    # "debug": true returns the stage timings; only honoured on a debug server
+    # or with STORY_MAP_TRACE_RESPONSES=1
+    return bool(data.get("debug")) and (app.debug or config.TRACE_RESPONSES)
+
+def run_traced(fn, return_trace, *args, **kwargs):
+    """
+    Runs generate_map or incremental_map with a trace of its stages. Every
+    trace goes to OpenTelemetry (if a tracer provider is set up) and, with
+    STORY_MAP_TRACE_LOG=1, to the log; it is only returned when asked for.
+    """
+    trace = Trace()
+    map_png, conflicts = fn(*args, trace=trace, **kwargs)
+    trace.export_otel()
+    if config.TRACE_LOG:
+        app.logger.info("trace %s", trace.to_json())
+    return map_png, conflicts, trace if return_trace else None
+
+def requested_profile(data):
+    # "preview" for quick maps while editing, "print" for a full-quality one
+    profile = data.get("profile")
+    try:
+        get_render_profile(profile)
+    except ValueError as e:
+        abort(make_response(jsonify({"error": str(e)}), 400))
+    return profile
 
 @app.route('/generate_map', methods=['POST'])
 def generate_map_endpoint():
     data = request.get_json()
     doc_text = data['content']
+    # with a doc_id (and STORY_MAP_LAYOUT_DIR set) the last layout is reused
+    layout_path = layout_store.document_path(data['doc_id']) if 'doc_id' in data else None
 
-    map_file_path, conflicts = generate_map(doc_text,1)
-    with open(map_file_path, "rb") as f:
-        img_bytes = f.read()
-    img_b64 = base64.b64encode(img_bytes).decode('utf-8')
+    profile = requested_profile(data)
 
-    return jsonify({
-        "map_png_base64": img_b64,
-        "conflicts": conflicts
-    })
+    map_png, conflicts, trace = run_traced(generate_map, wants_trace(data), doc_text, 1, layout_path=layout_path, profile=profile)
+    return map_response(map_png, conflicts, trace)
+
+class ResyncNeeded(Exception):
+    """The server doesn't have the client's previous version of the document."""
+
+@app.route('/generate_map_incremental', methods=['POST'])
+def generate_map_incremental_endpoint():
+    """
+    Like /generate_map, but the server remembers each document (by doc_id) and
+    only re-extracts the paragraphs that changed. The body holds "doc_id" and
+    either the whole document, as "paragraphs" (or "content", split on
+    newlines), or a list of "edits":
+        {"start": i, "end": j, "paragraphs": [...]}
+    each replacing paragraphs[start:end] of the result of the previous edit.
+    An optional "base_version" (see DocumentSession.version) is checked
+    before the edits and "paragraph_count" after them, "places" lists
+    place names known to the writer (they skip NER), and "profile" works as
+    for /generate_map. Answers 409 with
+    "resync": true when the client should send the whole document again.
+    """
+    data = request.get_json()
+    profile = requested_profile(data)
+    try:
+        map_png, conflicts, trace = run_traced(incremental_map, wants_trace(data), data, profile)
+    except ResyncNeeded as e:
+        return resync_response(str(e))
+    return map_response(map_png, conflicts, trace)
+
+def incremental_map(data, profile, trace=NO_TRACE):
+    doc_id = data['doc_id']
+    paragraphs = data.get("paragraphs")
+    if paragraphs is None and "content" in data:
+        paragraphs = data["content"].split("\n")
+
+    if paragraphs is not None:
+        session = sessions.get_or_create(doc_id)
+    else:
+        session = sessions.get(doc_id)
+        if session is None:
+            raise ResyncNeeded(f"unknown document {doc_id}")
+
+    with session.lock:
+        with trace.stage("extract") as attributes:
+            new_places = set()
+            if session.gazetteer is not None:
+                new_places = set(data.get("places", [])) - session.gazetteer.places
+                session.gazetteer.add(new_places)
+            if paragraphs is not None:
+                session.replace(paragraphs)
+            elif new_places:
+                # sentences about the new places are now extracted differently
+                session.replace(session.paragraphs)
+            base_version = data.get("base_version")
+            if paragraphs is None and base_version is not None and base_version != session.version():
+                raise ResyncNeeded("the edits are for another version of the document")
+            try:
+                for edit in data.get("edits", []):
+                    session.apply_edit(edit["start"], edit["end"], edit["paragraphs"])
+            except ValueError as e:
+                raise ResyncNeeded(str(e))
+            attributes["paragraphs"] = len(session.paragraphs)
+        expected = data.get("paragraph_count")
+        if expected is not None and expected != len(session.paragraphs):
+            raise ResyncNeeded(f"expected {expected} paragraphs, have {len(session.paragraphs)}")
+
+        # an unchanged document (e.g. "Generate Map" clicked twice) gets the same map
+        with trace.stage("cache") as attributes:
+            places = None if session.gazetteer is None else session.gazetteer.places
+            key = results.key("\n".join(session.paragraphs), 1, profile, layout=f"session:{doc_id}", places=places)
+            cached = results.get(key)
+            attributes["hit"] = cached is not None
+        if cached is not None:
+            return cached
+
+        # previous layout as the warm start keeps the map stable between edits
+        map_png, conflicts, coords = map_from_travel_info(session.travel_info(), 1, session.coords, profile=profile, trace=trace)
+        session.update_layout(coords)
+        if map_png is not None:
+            results.put(key, map_png, conflicts)
+        return map_png, conflicts
+
+@app.route('/jobs', methods=['POST'])
+def submit_job_endpoint():
+    """
+    Queues a map and answers 202 with its "job_id" straight away. A body with
+    a "doc_id" is handled like /generate_map_incremental, one with only
+    "content" like /generate_map. Poll GET /jobs/<job_id> for the result.
+    Answers 503 when too many jobs are already waiting.
+    """
+    data = request.get_json()
+    profile = requested_profile(data)
+    try:
+        if 'doc_id' in data:
+            job = jobs.submit(run_traced, incremental_map, wants_trace(data), data, profile)
+        else:
+            job = jobs.submit(run_traced, generate_map, wants_trace(data), data['content'], 1, profile=profile)
+    except QueueFull as e:
+        response = jsonify({"error": str(e)})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+    response = jsonify(job.describe())
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return response, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_endpoint(job_id):
+    """
+    202 with the job's status while it is queued or running, then the map
+    (negotiated as for /generate_map) once it is done. A failed incremental
+    job answers 409 with "resync": true like /generate_map_incremental.
+    Jobs are forgotten config.JOB_TTL seconds after they finish.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"unknown job {job_id}"}), 404
+    if job.status == "done":
+        map_png, conflicts, trace = job.result
+        return map_response(map_png, conflicts, trace)
+    if job.status == "failed":
+        if isinstance(job.error, ResyncNeeded):
+            return resync_response(str(job.error))
+        app.logger.error("Job %s failed: %r", job_id, job.error)
+        return jsonify(job.describe()), 500
+    return jsonify(job.describe()), 202
+
+@app.route('/conflicts', methods=['POST'])
+def conflicts_endpoint():
+    """
+    Only the conflicting sentence pairs, without solving or drawing a map.
+    Takes "content" like /generate_map, or just the "doc_id" of a document
+    already sent to /generate_map_incremental.
+    """
+    data = request.get_json()
+    if "content" in data:
+        travel_info = document_travel_info(data["content"])
+    else:
+        session = sessions.get(data["doc_id"])
+        if session is None:
+            return resync_response(f"unknown document {data['doc_id']}")
+        with session.lock:
+            travel_info = session.travel_info()
+    return jsonify({"conflicts": find_conflicts(travel_info)})
+
+@app.route('/health', methods=['GET'])
+def health_endpoint():
+    status = models.status()
+    status["jobs_pending"] = jobs.pending()
+    return jsonify(status), 200 if status["ready"] else 503
+
+@app.after_request
+def compress_response(response):
+    # PNG and WebP are already compressed; JSON (base64 maps, conflict lists)
+    # shrinks a lot. zstd when the client accepts it, gzip otherwise.
+    if (response.direct_passthrough or response.mimetype.startswith("image/")
+            or "Content-Encoding" in response.headers):
+        return response
+    encodings = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+    encoding = request.accept_encodings.best_match(encodings)
+    data = response.get_data()
+    if encoding is None or len(data) < MIN_COMPRESS_SIZE:
+        return response
+    if encoding == "zstd":
+        data = zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        data = gzip.compress(data, compresslevel=6)
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+def warm_up_in_background():
+    # Load the models while the server is already accepting connections;
+    # /health reports 503 until they are ready.
+    def run():
+        try:
+            models.warm_up()
+        except Exception as e:
+            app.logger.error("Model warm-up failed: %r", e)
+    threading.Thread(target=run, daemon=True).start()
 
 if __name__ == '__main__':
+    warm_up_in_background()
     app.run(port=8080)
 
 
-#run locally with 
+#run locally with
 # python -m src.app and test with:
 # curl -X POST http://localhost:8080/generate_map \
     #  -H "Content-Type: application/json" \
-    #  -d '{"content": "They went from Lok to Erendale in one day."}' \ 
+    #  -d '{"content": "They went from Lok to Erendale in one day."}' \
     #  --output map.png
+# after a first call with the whole document, e.g.
+# -d '{"doc_id": "d1", "content": "They went from Lok to Erendale in one day."}'
+# send only the edited paragraphs to /generate_map_incremental:
+# -d '{"doc_id": "d1", "edits": [{"start": 1, "end": 1, "paragraphs": ["Erendale is north of Lok."]}]}'
+# ask for the PNG itself (conflicts in the X-Story-Map-Conflicts header) with
+# -H "Accept: image/png", or only the conflicts with POST /conflicts
+# or queue a map and poll for it (slow documents, Apps Script's fetch timeout):
+# curl -X POST http://localhost:8080/jobs -H "Content-Type: application/json" -d '{"content": "..."}'
+# curl http://localhost:8080/jobs/<job_id> -H "Accept: image/png" --output map.png
+# check whether the models are loaded with:
+# curl http://localhost:8080/health
 
 #run for Google Docs integration with:
 # python -m src.app
+# or, to serve several editors at once, with src/serve.py:
+# python -m src.serve
 #ngrok http 8080
\ No newline at end of file
@@ -0,0 +1,211 @@
+# End-to-end benchmark: times every stage of the map pipeline on the bundled
+# examples and on synthetic stories of growing size, and prints JSON.
+#
+# usage: python3 -m src.benchmark [--sizes 10:40 50:200 200:800] [--output bench.json]
+# NER is replaced by a stub (capitalized words are places), so no transformer
+# model is needed; the spaCy model still is. --compare-ner spacy transformers onnx
+# also measures the real NER backends' speed against their precision and recall.
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import time
+import numpy as np
+from spacy.lang.en.stop_words import STOP_WORDS
+from src import config, extractor, models
+from src.cache import ResultCache
+from src.generator import generate_map
+from src.terrain import DEFAULT_PROFILE, RENDER_PROFILES
+from src.tracing import Trace
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+CAPITALIZED = re.compile(r"\b[A-Z][a-z]+\b")
+NOT_PLACES = set(STOP_WORDS) | {
+    "january", "february", "march", "april", "june", "july", "august", "september",
+    "october", "november", "december", "monday", "tuesday", "wednesday", "thursday",
+    "friday", "saturday", "sunday",
+}
+
+def stub_ner(texts, batch_size=None):
+    """Same output shape as the transformers NER pipeline (aggregated entities)."""
+    single = isinstance(texts, str)
+    results = []
+    for text in [texts] if single else texts:
+        results.append([
+            {"entity_group": "LOC", "word": m.group(), "start": m.start(), "end": m.end(), "score": 1.0}
+            for m in CAPITALIZED.finditer(text) if m.group().lower() not in NOT_PLACES
+        ])
+    return results[0] if single else results
+
+SYLLABLES = ["ka", "ro", "dun", "mir", "el", "tha", "vor", "ish", "an", "bel", "ga", "lor",
+             "ne", "sti", "ul", "wen", "zar", "o", "fen", "dra"]
+COMPASS = ["east", "northeast", "north", "northwest", "west", "southwest", "south", "southeast"]
+OPPOSITE = {d: COMPASS[(i + 4) % 8] for i, d in enumerate(COMPASS)}
+
+def place_names(n, rng):
+    names = set()
+    while len(names) < n:
+        name = "".join(rng.choice(SYLLABLES, size=rng.integers(2, 4))).capitalize()
+        if name.lower() not in NOT_PLACES:
+            names.add(name)
+    return sorted(names)
+
+def compass(a, b):
+    """Direction of a as seen from b."""
+    dx, dy = a - b
+    return COMPASS[int(np.round(np.arctan2(dy, dx) / (np.pi / 4))) % 8]
+
+def synthetic_story(n_locations, n_sentences, conflict_rate=0.1, direction_rate=0.3,
+                    sentences_per_paragraph=5, seed=0):
+    """
+    A story about n_locations places scattered on a plane, told in n_sentences
+    travel ("They travelled from A to B in 12 days.") and direction ("A is
+    north of B.") sentences. Durations follow the walking pace and directions
+    the true positions, except that about conflict_rate of the sentences
+    contradict an earlier one about the same pair of places.
+    """
+    rng = np.random.default_rng(seed)
+    names = place_names(n_locations, rng)
+    positions = rng.uniform(0, 40 * extractor.walking_pace, size=(n_locations, 2))
+    told = []  # (i, j, kind) already in the story, for conflicts to contradict
+    sentences = []
+    for _ in range(n_sentences):
+        if told and rng.random() < conflict_rate:
+            i, j, kind = told[rng.integers(len(told))]
+            wrong = True
+        else:
+            i, j = rng.choice(n_locations, size=2, replace=False)
+            kind = "direction" if rng.random() < direction_rate else "travel"
+            wrong = False
+            told.append((i, j, kind))
+        if kind == "travel":
+            days = max(1, int(round(np.linalg.norm(positions[i] - positions[j]) / extractor.walking_pace)))
+            if wrong:
+                days = days * 3 + 5
+            sentences.append(f"They travelled from {names[i]} to {names[j]} in {days} days.")
+        else:
+            direction = compass(positions[i], positions[j])
+            if wrong:
+                direction = OPPOSITE[direction]
+            sentences.append(f"{names[i]} is {direction} of {names[j]}.")
+    paragraphs = [" ".join(sentences[k:k + sentences_per_paragraph])
+                  for k in range(0, len(sentences), sentences_per_paragraph)]
+    return "\n".join(paragraphs)
+
+def compare_ner(backends, n_locations, n_sentences, seed):
+    """
+    Runs each NER backend ("stub" or one of models.NER_BACKENDS) over the
+    sentences of a synthetic story, whose place names are known, and reports
+    load time, sentences per second, precision and recall of the places found.
+    """
+    text = synthetic_story(n_locations, n_sentences, seed=seed)
+    names = place_names(n_locations, np.random.default_rng(seed))  # the ones synthetic_story used
+    sents = [sent for doc in models.get_nlp().pipe(extractor.split_paragraphs(text)) for sent in doc.sents]
+    truth = [{name for name in names if re.search(rf"\b{name}\b", sent.text)} for sent in sents]
+
+    results = []
+    for backend in backends:
+        start = time.perf_counter()
+        if backend == "stub":
+            models.use_ner_backend("transformers")
+            models.set_model("ner", stub_ner)
+        else:
+            models.use_ner_backend(backend)
+            models.get_ner()
+        load_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        entities = extractor.sentence_entities(sents)
+        ner_s = time.perf_counter() - start
+
+        # only places count, as in extract_travel_info (PER/ORG/MISC are not places)
+        found = [{ent["word"] for ent in ents if ent.get("entity_group") == "LOC"} for ents in entities]
+        true_positives = sum(len(f & t) for f, t in zip(found, truth))
+        predicted = sum(len(f) for f in found)
+        actual = sum(len(t) for t in truth)
+        results.append({
+            "backend": backend,
+            "sentences": len(sents),
+            "load_s": round(load_s, 6),
+            "ner_s": round(ner_s, 6),
+            "sentences_per_s": round(len(sents) / ner_s, 1) if ner_s else None,
+            "precision": round(true_positives / predicted, 4) if predicted else None,
+            "recall": round(true_positives / actual, 4) if actual else None,
+        })
+    # the pipeline benchmarks run with the stub
+    models.use_ner_backend("transformers")
+    models.set_model("ner", stub_ner)
+    return results
+
+def benchmark(name, text, profile, seed, memory=True):
+    """Runs generate_map on the text with nothing cached and returns its trace."""
+    trace = Trace(name, memory)
+    generate_map(text, 1, seed=seed, profile=profile, cache=ResultCache(max_bytes=0), trace=trace)
+    result = {"name": name, "chars": len(text), "paragraphs": len(extractor.split_paragraphs(text))}
+    result.update(trace.to_dict())
+    return result
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the map pipeline.")
+    parser.add_argument("--sizes", nargs="*", default=["10:40", "50:200", "200:800"],
+                        help="synthetic stories as LOCATIONS:SENTENCES")
+    parser.add_argument("--conflict-rate", type=float, default=0.1)
+    parser.add_argument("--no-examples", action="store_true", help="skip src/data/example*.txt")
+    parser.add_argument("--profile", choices=RENDER_PROFILES, default=DEFAULT_PROFILE)
+    parser.add_argument("--seed", type=int, default=0, help="seed for the stories and the solver")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows everything down")
+    parser.add_argument("--compare-ner", nargs="*", default=[], metavar="BACKEND",
+                        choices=["stub"] + list(models.NER_BACKENDS),
+                        help="NER backends to compare for speed and accuracy (needs their models)")
+    parser.add_argument("--compare-size", default="50:400", help="story for --compare-ner, as LOCATIONS:SENTENCES")
+    parser.add_argument("--output", help="write the JSON here instead of printing it")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    memory = not args.no_memory
+    models.use_ner_backend("transformers")
+    models.set_model("ner", stub_ner)
+    # every run starts cold, whatever the environment configures
+    config.EXTRACTION_CACHE_SIZE = 0
+    config.EXTRACTION_CACHE_PATH = None
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "profile": args.profile,
+        "seed": args.seed,
+        "examples": [],
+        "synthetic": [],
+    }
+    if not args.no_examples:
+        for path in sorted(glob.glob(os.path.join(DATA_DIR, "example*.txt")),
+                           key=lambda p: int(re.search(r"(\d+)", os.path.basename(p)).group(1))):
+            with open(path, "r") as f:
+                text = f.read()
+            report["examples"].append(benchmark(os.path.basename(path), text, args.profile, args.seed, memory))
+    for size in args.sizes:
+        n_locations, n_sentences = (int(n) for n in size.split(":"))
+        text = synthetic_story(n_locations, n_sentences, args.conflict_rate, seed=args.seed)
+        result = benchmark(f"synthetic-{size}", text, args.profile, args.seed, memory)
+        result.update({"locations": n_locations, "sentences": n_sentences, "conflict_rate": args.conflict_rate})
+        report["synthetic"].append(result)
+
+    if args.compare_ner:
+        n_locations, n_sentences = (int(n) for n in args.compare_size.split(":"))
+        report["ner"] = compare_ner(args.compare_ner, n_locations, n_sentences, args.seed)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
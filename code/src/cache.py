@@ -0,0 +1,224 @@
+# Content-addressed caches so unchanged text skips parsing and NER, and
+# unchanged documents skip the whole map pipeline.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from src import config, models
+from src.terrain import DEFAULT_PROFILE
+
+UNSAVED_LIMIT = 10_000  # buffered sqlite writes flushed early past this many
+
+class ExtractionCache:
+    """
+    LRU cache of extraction results keyed by a hash of the text plus the model
+    fingerprint. Values must be JSON-serializable; every get returns a fresh
+    copy, so callers may mutate what they get back.
+
+    If a path is given, entries are also written to a sqlite file so they
+    survive restarts and can be shared between processes. Those writes are
+    buffered until flush() (extractor.extract_paragraphs calls it once per
+    call), so a long document costs one commit rather than one per sentence.
+    """
+    def __init__(self, max_entries=None, path=None):
+        self.max_entries = config.EXTRACTION_CACHE_SIZE if max_entries is None else max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._db = None
+        self._unsaved = {}
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text, kind="sentence"):
+        if self._fingerprint is None:
+            self._fingerprint = models.fingerprint()
+        raw = f"{kind}\0{self._fingerprint}\0{text}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, text, kind="sentence"):
+        key = self.key(text, kind)
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            elif self._db is not None:
+                value = self._unsaved.get(key)
+                if value is None:
+                    row = self._db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                    if row:
+                        value = row[0]
+                if value is not None:
+                    self._remember(key, value)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(value)
+
+    def put(self, text, value, kind="sentence"):
+        key = self.key(text, kind)
+        value = json.dumps(value)
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._unsaved[key] = value
+                if len(self._unsaved) >= UNSAVED_LIMIT:
+                    self._flush()
+
+    def flush(self):
+        """Writes the buffered entries to the sqlite file in one transaction."""
+        with self._lock:
+            self._flush()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._unsaved.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM entries")
+                self._db.commit()
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _flush(self):
+        if self._db is None or not self._unsaved:
+            return
+        self._db.executemany("INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", self._unsaved.items())
+        self._db.commit()
+        self._unsaved.clear()
+
+_extraction_cache = None
+_extraction_cache_lock = threading.Lock()
+
+def get_extraction_cache():
+    """The process-wide cache used by extractor.get_all_travel_info by default."""
+    global _extraction_cache
+    with _extraction_cache_lock:
+        if _extraction_cache is None:
+            _extraction_cache = ExtractionCache(path=config.EXTRACTION_CACHE_PATH)
+        return _extraction_cache
+
+class ResultCache:
+    """
+    Finished maps (PNG bytes and conflict list) keyed by a hash of the text
+    and the options that shape the map. Memory use is bounded by max_bytes,
+    evicting the least recently used maps. If a directory is given, maps are
+    also written there as <key>.png and <key>.json so they survive restarts.
+    """
+    def __init__(self, max_bytes=None, directory=None):
+        self.max_bytes = config.RESULT_CACHE_BYTES if max_bytes is None else max_bytes
+        self.directory = directory
+        self._memory = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text, with_routes=1, profile=None, seed=None, layout=None, places=None):
+        """
+        layout names the stored layout the map started from (doc id or path),
+        if any; places are the names the extractor.Gazetteer knew (None
+        when there is none), since they change what is extracted.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = f"{models.fingerprint()}|{config.MAP_VERSION}"
+        places = None if places is None else sorted(places)
+        options = json.dumps([bool(with_routes), profile or DEFAULT_PROFILE, seed, layout, places])
+        raw = f"map\0{self._fingerprint}\0{options}\0{text}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            elif self.directory:
+                value = self._read(key)
+                if value is not None:
+                    self._remember(key, value)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        png, conflicts = value
+        return png, [tuple(pair) for pair in json.loads(conflicts)]
+
+    def put(self, key, png, conflicts):
+        value = (png, json.dumps(conflicts))
+        with self._lock:
+            self._remember(key, value)
+            if self.directory:
+                self._write(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._size = 0
+            if self.directory:
+                for name in os.listdir(self.directory):
+                    if name.endswith((".png", ".json")):
+                        os.remove(os.path.join(self.directory, name))
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _remember(self, key, value):
+        size = len(value[0]) + len(value[1])
+        if size > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._size -= len(old[0]) + len(old[1])
+        self._memory[key] = value
+        self._size += size
+        while self._size > self.max_bytes:
+            _, (png, conflicts) = self._memory.popitem(last=False)
+            self._size -= len(png) + len(conflicts)
+
+    def _read(self, key):
+        base = os.path.join(self.directory, key)
+        try:
+            with open(base + ".json", "r") as f:
+                conflicts = f.read()
+            with open(base + ".png", "rb") as f:
+                png = f.read()
+        except OSError:
+            return None
+        return png, conflicts
+
+    def _write(self, key, value):
+        # conflicts last: a map only counts as stored once its .json exists
+        base = os.path.join(self.directory, key)
+        for suffix, data, mode in ((".png", value[0], "wb"), (".json", value[1], "w")):
+            tmp = f"{base}{suffix}.tmp"
+            with open(tmp, mode) as f:
+                f.write(data)
+            os.replace(tmp, base + suffix)
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """The process-wide cache used by generator.generate_map by default."""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(directory=config.RESULT_CACHE_DIR)
+        return _result_cache
@@ -1 +1,88 @@
-all_entries = {}
\ No newline at end of file
+import os
+
+# NLP models shared by every request (see src/models.py)
+SPACY_MODEL = "en_core_web_sm"
+NER_MODEL = "dbmdz/bert-large-cased-finetuned-conll03-english"
+# How places are recognized (STORY_MAP_NER or --ner): "transformers" runs
+# NER_MODEL as is, "onnx" an int8-quantized ONNX Runtime export of it (faster
+# on CPU, kept in NER_ONNX_DIR; needs pip install "optimum[onnxruntime]"),
+# "spacy" takes the entities from the spaCy parse (fastest, lower recall on
+# invented place names)
+NER_BACKEND = os.environ.get("STORY_MAP_NER", "transformers")
+NER_ONNX_DIR = os.environ.get("STORY_MAP_NER_ONNX_DIR", os.path.expanduser("~/.cache/story-map/ner-onnx"))
+
+# Place names known before NER runs (extractor.Gazetteer): each document
+# keeps the places found so far, plus those in an optional place list for the
+# whole project (STORY_MAP_PLACES or main.py --places; one name per line), and
+# sentences mentioning only known places skip NER. STORY_MAP_GAZETTEER=0
+# runs NER on every candidate sentence instead.
+GAZETTEER = os.environ.get("STORY_MAP_GAZETTEER", "1") != "0"
+PLACES_FILE = os.environ.get("STORY_MAP_PLACES")
+
+# Sentences sent to the NER pipeline per forward pass
+NER_BATCH_SIZE = 16
+
+# src/main.py parses inputs at least this long with nlp.pipe over
+# SPACY_N_PROCESS processes; servers always parse in-process
+SPACY_MULTIPROCESS_MIN_CHARS = 500_000
+SPACY_N_PROCESS = 2
+
+# Streaming extraction of long files (extractor.iter_travel_info, main.py
+# --stream): characters read at a time, characters extracted per batch, and
+# the longest paragraph kept whole
+STREAM_CHUNK_CHARS = 1 << 20
+STREAM_BATCH_CHARS = 100_000
+STREAM_MAX_PARAGRAPH_CHARS = 100_000
+
+# Sentence-level extraction cache (see src/cache.py). Set STORY_MAP_CACHE_DB to
+# a file path to keep results on disk between runs.
+EXTRACTION_CACHE_SIZE = 50_000
+EXTRACTION_CACHE_PATH = os.environ.get("STORY_MAP_CACHE_DB")
+# Bump whenever the extraction rules change so stale cached results are ignored
+EXTRACTOR_VERSION = 3
+
+# Whole-map cache (see cache.ResultCache): memory for finished maps, and an
+# optional directory (STORY_MAP_RESULT_CACHE_DIR) keeping them between runs.
+RESULT_CACHE_BYTES = 128 * 1024 * 1024
+RESULT_CACHE_DIR = os.environ.get("STORY_MAP_RESULT_CACHE_DIR")
+# Bump whenever solving or rendering changes so cached maps are redrawn
+MAP_VERSION = 1
+
+# Documents kept in memory for incremental map generation (see src/sessions.py)
+MAX_SESSIONS = 100
+# Directory where the server keeps each document's last layout so maps stay
+# stable across restarts (see src/layout_store.py); unset keeps them in memory only
+LAYOUT_DIR = os.environ.get("STORY_MAP_LAYOUT_DIR")
+
+# Layout solver (see solver.get_coords). More starts give better, more stable
+# layouts at the cost of extra solves. src/main.py spreads them over
+# SOLVER_WORKERS processes (None = one per CPU); servers solve in-process.
+# A fixed seed makes layouts reproducible.
+SOLVER_STARTS = 1
+SOLVER_SEED = None
+SOLVER_WORKERS = None
+# Below this many residuals in total, solves run in-process even with a pool
+SOLVER_PARALLEL_MIN_RESIDUALS = 500
+
+# Background map jobs (see src/jobs.py): JOB_WORKERS run at once, at most
+# JOB_QUEUE_SIZE wait, and finished jobs are dropped after JOB_TTL seconds
+# or, past JOB_MAX_FINISHED of them (each holds a map), oldest first.
+# NER calls within one process go one at a time (models.ner_lock); under
+# src/serve.py each worker process has its own models, so they run at once.
+JOB_WORKERS = 4
+JOB_QUEUE_SIZE = 32
+JOB_TTL = 600
+JOB_MAX_FINISHED = 64
+
+# Serving with python -m src.serve (see src/serve.py): threads answering
+# requests, and processes that extract, solve and render maps (None = one per CPU)
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8080
+SERVE_THREADS = 8
+SERVE_PROCESSES = None
+
+# Stage traces of every map (see src/tracing.py): STORY_MAP_TRACE_LOG=1 logs
+# them as JSON lines, and STORY_MAP_TRACE_RESPONSES=1 lets a request ask for
+# its own with "debug": true (always allowed when Flask runs in debug mode)
+TRACE_LOG = os.environ.get("STORY_MAP_TRACE_LOG") == "1"
+TRACE_RESPONSES = os.environ.get("STORY_MAP_TRACE_RESPONSES") == "1"
@@ -3,28 +3,79 @@ def extract_travel_info(text: str) -> dict:
     # return dict with {origin, destination, mode, duration_days}
     ...
 
-from transformers import pipeline, logging
-import spacy
+import os
 import re
+from functools import lru_cache
 from word2number import w2n
 import numpy as np
 from collections import defaultdict
-from src import config
+from src import config, models
+from src.cache import get_extraction_cache
 
 class Entry:
-    sentence_count = 1
-    def __init__(self, sentence):
-        self.sentence_id = Entry.sentence_count
+    def __init__(self, sentence_id, sentence):
+        self.sentence_id = sentence_id
         self.sentence = sentence
         self.sent_info = []
-        Entry.sentence_count += 1
     
     def __repr__(self):
         return f"Sentence {self.sentence_id}: {self.sentence}"
 
-sentence_count = 0
+class ExtractionContext:
+    """
+    The sentences of one document, numbered from 1 in reading order. Every
+    extraction gets its own context, so concurrent requests never share
+    sentences or numbering.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def add(self, sentence, sent_info):
+        entry = Entry(len(self.entries) + 1, sentence)
+        entry.sent_info = sent_info
+        self.entries[entry.sentence_id] = entry
+        return entry
+
+class Gazetteer:
+    """
+    The place names known for one document: those in the user's place list
+    (config.PLACES_FILE) and those found so far. A sentence whose place slots
+    (place_candidates) all hold known places skips NER.
+    """
+    def __init__(self, places=()):
+        self.places = set(places)
+
+    @classmethod
+    def for_document(cls):
+        """A new gazetteer, or None when config.GAZETTEER is off."""
+        if not config.GAZETTEER:
+            return None
+        return cls(project_places())
+
+    def add(self, names):
+        self.places.update(names)
+
+    def add_info(self, info):
+        self.add(get_all_locations([info]))
+
+    def knows_all(self, names):
+        return names <= self.places
 
-logging.set_verbosity_error()
+    def entities(self, names):
+        # in the NER pipeline's format, for extract_travel_info
+        return [{"entity_group": "LOC", "word": name} for name in names]
+
+def project_places():
+    """The names in config.PLACES_FILE, re-read whenever the file changes."""
+    if not config.PLACES_FILE:
+        return frozenset()
+    return load_places(config.PLACES_FILE, os.stat(config.PLACES_FILE).st_mtime_ns)
+
+@lru_cache(maxsize=8)
+def load_places(path, mtime=None):
+    """A place list file: one name per line, # for comments."""
+    with open(path, "r") as f:
+        return frozenset(line.strip() for line in f if line.strip() and not line.startswith("#"))
 
 walking_pace = 20
 DEFAULT_DAYS = 10  # number of days to assume when none given
@@ -70,45 +121,186 @@ def get_distances(travel_info):
     distances = {}
 
     for info in travel_info:
-        entry = info["entry"]
-        locs = info['locations']
-
-        # Compute real distance if date present
-        is_real = bool(info['date'])
-        if is_real:
-            date_text = info['date'][0]
-            total_distance = days_to_distance(days(date_text), walking_pace)
-        else:
-            total_distance = days_to_distance(days(f"{DEFAULT_DAYS} days"), walking_pace)
+        add_distances(distances, info)
 
-        segments = len(locs) - 1
-        if segments > 0:
-            segment_distance = total_distance / segments
-            for i in range(segments):
-                pair = tuple(sorted((locs[i], locs[i + 1]))) 
-                
-                if pair not in distances:
-                    distances[pair] = [(segment_distance, entry, "real" if is_real else "default")]
+    return distances
 
-                else:
-                    prev_d, prev_entry, prev_type = distances[pair][0]
+def add_distances(distances, info):
+    """Adds the distances of one trip to a dict built by get_distances."""
+    entry = info["entry"]
+    locs = info['locations']
+
+    # Compute real distance if date present
+    is_real = bool(info['date'])
+    if is_real:
+        date_text = info['date'][0]
+        total_distance = days_to_distance(days(date_text), walking_pace)
+    else:
+        total_distance = days_to_distance(days(f"{DEFAULT_DAYS} days"), walking_pace)
+
+    segments = len(locs) - 1
+    if segments > 0:
+        segment_distance = total_distance / segments
+        for i in range(segments):
+            pair = tuple(sorted((locs[i], locs[i + 1]))) 
+            
+            if pair not in distances:
+                distances[pair] = [(segment_distance, entry, "real" if is_real else "default")]
 
-                    if prev_type == "default" and is_real:
-                        distances[pair] = [(segment_distance, entry, "real")]
+            else:
+                prev_d, prev_entry, prev_type = distances[pair][0]
 
-                    elif prev_type == "real" and is_real:
-                        distances[pair].append((segment_distance, entry, "real"))
+                if prev_type == "default" and is_real:
+                    distances[pair] = [(segment_distance, entry, "real")]
 
-        # Fallback for direction-only sentences
-        if not info.get("date"):
-            for (a, b, _) in info.get("directions", []):
-                pair = (a, b)
-                if pair not in distances:
-                    distances[pair] = [(default_distance(), entry, "default")]
+                elif prev_type == "real" and is_real:
+                    distances[pair].append((segment_distance, entry, "real"))
 
-    return distances
+    # Fallback for direction-only sentences
+    if not info.get("date"):
+        for (a, b, _) in info.get("directions", []):
+            pair = (a, b)
+            if pair not in distances:
+                distances[pair] = [(default_distance(), entry, "default")]
+
+def split_paragraphs(text):
+    return [p for p in text.splitlines() if p.strip()]
+
+# Processes for parsing very large inputs, set by src/main.py. Servers keep
+# 1 so a long document never forks the threaded server process.
+_parse_processes = 1
+
+def use_parse_processes(n_process):
+    global _parse_processes
+    _parse_processes = n_process
 
-def get_all_travel_info(paragraph: str):
+def parse_paragraphs(paragraphs, nlp, n_process=None):
+    """
+    Parses every paragraph exactly once and yields the Docs in order. Very
+    large inputs are spread over several processes if use_parse_processes
+    allowed it.
+    """
+    if n_process is None:
+        total = sum(len(p) for p in paragraphs)
+        n_process = _parse_processes if total >= config.SPACY_MULTIPROCESS_MIN_CHARS else 1
+    return nlp.pipe(paragraphs, n_process=n_process)
+
+def _cached_info(info):
+    # JSON turns the direction tuples into lists
+    info["directions"] = [tuple(d) for d in info.get("directions", [])]
+    return info
+
+def _cached_paragraph(paragraph, cache, gazetteer=None):
+    # the paragraph entry holds each sentence's text and place slots
+    sentences = cache.get(paragraph, kind="paragraph")
+    if sentences is None:
+        return None
+    results = []
+    for text, names in sentences:
+        info = _cached_sentence(text, set(names), cache, gazetteer)
+        if info is None:
+            return None
+        results.append((text, info))
+    return results
+
+def _cached_sentence(text, names, cache, gazetteer):
+    # a sentence whose places are all known is extracted from the gazetteer,
+    # so that result is cached apart from the NER one
+    if names and gazetteer is not None and gazetteer.knows_all(names):
+        info = cache.get(text, kind="gazetteer")
+    else:
+        info = cache.get(text)
+    return None if info is None else _cached_info(info)
+
+def _gazetteer_info(sent, names, cache, gazetteer):
+    info = extract_travel_info(sent, gazetteer.entities(names))
+    cache.put(sent.text, info, kind="gazetteer")
+    return info
+
+def extract_paragraphs(paragraphs, batch_size=None, n_process=None, cache=None, gazetteer=None):
+    """
+    Returns, for every paragraph, the list of (sentence text, sent_info)
+    pairs. Paragraphs whose sentences are all cached skip parsing, and
+    cached sentences skip NER. With a gazetteer, so do sentences whose
+    places it already knows; the places found are added to it.
+    """
+    if cache is None:
+        cache = get_extraction_cache()
+
+    results = [None] * len(paragraphs)
+    missing = []
+    for i, paragraph in enumerate(paragraphs):
+        if not paragraph.strip():
+            results[i] = []
+            continue
+        results[i] = _cached_paragraph(paragraph, cache, gazetteer)
+        if results[i] is None:
+            missing.append(i)
+        elif gazetteer is not None:
+            for _, info in results[i]:
+                gazetteer.add_info(info)
+    if not missing:
+        return results
+
+    pending = []  # (paragraph index, sentence index, span, place slots) still needing NER
+    docs = parse_paragraphs([paragraphs[i] for i in missing], models.get_nlp(), n_process)
+    for i, doc in zip(missing, docs):
+        sents = list(doc.sents)
+        slots = []
+        results[i] = [None] * len(sents)
+        for j, sent in enumerate(sents):
+            names = place_candidates(sent) if needs_ner(sent) else set()
+            slots.append([sent.text, sorted(names)])
+            info = _cached_sentence(sent.text, names, cache, gazetteer)
+            if info is not None:
+                results[i][j] = (sent.text, info)
+                if gazetteer is not None:
+                    gazetteer.add_info(info)
+            elif not names:
+                # only a date (e.g. "It took 30 days.") or nothing at all
+                info = extract_travel_info(sent, [])
+                cache.put(sent.text, info)
+                results[i][j] = (sent.text, info)
+            elif gazetteer is not None and gazetteer.knows_all(names):
+                results[i][j] = (sent.text, _gazetteer_info(sent, names, cache, gazetteer))
+            else:
+                pending.append((i, j, sent, names))
+        cache.put(paragraphs[i], slots, kind="paragraph")
+
+    batch_size = batch_size or config.NER_BATCH_SIZE
+    size = 1
+    while pending:
+        if gazetteer is None:
+            batch, pending = pending, []
+        else:
+            # a batch at a time, so the places found in one let later
+            # sentences that only mention them skip NER. Batches start at
+            # one sentence and double up to batch_size, so even a short
+            # document benefits from its first places.
+            unknown = []
+            for i, j, sent, names in pending:
+                if gazetteer.knows_all(names):
+                    results[i][j] = (sent.text, _gazetteer_info(sent, names, cache, gazetteer))
+                else:
+                    unknown.append((i, j, sent, names))
+            batch, pending = unknown[:size], unknown[size:]
+            size = min(2 * size, batch_size)
+
+        sent_entities = sentence_entities([sent for _, _, sent, _ in batch], batch_size)
+        for (i, j, sent, names), entities in zip(batch, sent_entities):
+            info = extract_travel_info(sent, entities)
+            cache.put(sent.text, info)
+            if gazetteer is not None:
+                gazetteer.add(ent["word"] for ent in entities if ent.get("entity_group") == "LOC")
+                if gazetteer.knows_all(names):
+                    # what the next run will find in the cache
+                    info = _gazetteer_info(sent, names, cache, gazetteer)
+            results[i][j] = (sent.text, info)
+
+    cache.flush()
+    return results
+
+def get_all_travel_info(paragraph: str, batch_size=None, n_process=None, cache=None, gazetteer=None):
     """
     Extracts and merges travel events that may be spread across sentences.
     Handles:
@@ -118,31 +310,114 @@ def get_all_travel_info(paragraph: str):
       - conflicting directions ("A is north of B. A is south of B.")
     """
 
-    config.all_entries = {} # clear past sentences
-    Entry.sentence_count = 1
+    if gazetteer is None:
+        gazetteer = Gazetteer.for_document()
+    paragraphs = split_paragraphs(paragraph)
+    return travel_info_from_sentences(extract_paragraphs(paragraphs, batch_size, n_process, cache, gazetteer))
 
-    nlp = spacy.load("en_core_web_sm")
-    ner = pipeline(
-        "ner",
-        model="dbmdz/bert-large-cased-finetuned-conll03-english",
-        aggregation_strategy="first"
-    )
+def travel_info_from_sentences(paragraph_sentences, context=None):
+    """
+    Numbers the already extracted sentences of a document (one list of
+    (text, sent_info) pairs per paragraph) and merges them into trips.
+    """
+    if context is None:
+        context = ExtractionContext()
 
-    doc = nlp(paragraph)
+    for sentences in paragraph_sentences:
+        for text, info in sentences:
+            context.add(text, info)
 
-    for sent in doc.sents:
-        id = Entry.sentence_count
-        entry = Entry(sent.text)
-        config.all_entries[id] = entry
-        entry.sent_info = extract_travel_info(sent.text, nlp, ner)
+    return merge_travel_info(context.entries.values())
 
-    merged = []
+def iter_paragraphs(stream, chunk_size=None, max_chars=None):
+    """
+    Yields the non-blank lines (paragraphs) of a text stream, reading
+    chunk_size characters at a time. A line longer than max_chars is cut at
+    its last sentence end before that, so memory stays bounded either way.
+    """
+    chunk_size = chunk_size or config.STREAM_CHUNK_CHARS
+    max_chars = max_chars or config.STREAM_MAX_PARAGRAPH_CHARS
+    rest = ""
+    while chunk := stream.read(chunk_size):
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+        while len(rest) > max_chars:
+            cut = rest.rfind(". ", 0, max_chars) + 1 or max_chars
+            yield rest[:cut]
+            rest = rest[cut:].lstrip()
+    if rest.strip():
+        yield rest
+
+def iter_sentences(paragraphs, batch_chars=None, cache=None, gazetteer=None):
+    """
+    Extracts paragraphs from any iterable a batch (about batch_chars
+    characters) at a time and yields the (text, sent_info) of every sentence.
+    One gazetteer is kept across the batches.
+    """
+    if gazetteer is None:
+        gazetteer = Gazetteer.for_document()
+    batch_chars = batch_chars or config.STREAM_BATCH_CHARS
+    batch, size = [], 0
+    for paragraph in paragraphs:
+        batch.append(paragraph)
+        size += len(paragraph)
+        if size >= batch_chars:
+            for sentences in extract_paragraphs(batch, cache=cache, gazetteer=gazetteer):
+                yield from sentences
+            batch, size = [], 0
+    for sentences in extract_paragraphs(batch, cache=cache, gazetteer=gazetteer):
+        yield from sentences
+
+def iter_travel_info(paragraphs, batch_chars=None, cache=None, gazetteer=None):
+    """
+    get_all_travel_info for texts too long to hold at once: takes paragraphs
+    from any iterable (e.g. iter_paragraphs(file)) and yields the trips as
+    they are complete. Sentences are numbered as they go, without being kept.
+    """
+    def entries():
+        for sentence_id, (text, info) in enumerate(iter_sentences(paragraphs, batch_chars, cache, gazetteer), start=1):
+            entry = Entry(sentence_id, text)
+            entry.sent_info = info
+            yield entry
+
+    yield from iter_merged_trips(entries())
+
+class TravelSummary:
+    """
+    What the solver needs from a story (locations, distances and direction
+    constraints), updated one trip at a time so the trips needn't be kept.
+    """
+    def __init__(self):
+        self.locations = set()
+        self.distances = {}
+        self.direction_constraints = defaultdict(list)
+        self.direction_conflicts = defaultdict(list)
+        self.trips = 0
+
+    def add(self, info):
+        self.locations.update(get_all_locations([info]))
+        add_distances(self.distances, info)
+        add_direction_constraints(self.direction_constraints, self.direction_conflicts, info)
+        self.trips += 1
+
+def merge_travel_info(entries):
+    return list(iter_merged_trips(entries))
+
+def iter_merged_trips(entries):
+    """
+    Merges sentences into trips as they come and yields every trip (followed
+    by its conflicting variants) once the next trip begins, so only the
+    current trip is held.
+    """
     current = None
     conflicts = []
     current_has_date = False
     current_has_direction = False
 
-    for entry in config.all_entries.values():
+    for entry in entries:
         info = entry.sent_info
         has_path = bool(info.get("locations"))
         has_date = bool(info.get("date"))
@@ -151,13 +426,14 @@ def get_all_travel_info(paragraph: str):
         # New trip begins
         if has_path or has_direction:
             if current:
-                merged.append(current)
-                merged += conflicts
+                yield current
+                yield from conflicts
                 conflicts = []
+            # copies, so extending a trip never changes the sentence's own info
             current = {
-                "locations": info.get("locations", []),
-                "date": info.get("date", []),
-                "directions": info.get("directions", []),
+                "locations": list(info.get("locations", [])),
+                "date": list(info.get("date", [])),
+                "directions": list(info.get("directions", [])),
                 "entry": [entry],
             }
             current_has_date = bool(info.get("date"))
@@ -194,10 +470,8 @@ def get_all_travel_info(paragraph: str):
                 })
 
     if current:
-        merged.append(current)
-        merged += conflicts
-
-    return merged
+        yield current
+        yield from conflicts
 
 
 TRAVEL_WORDS = {"travel", "journey", "go", "went", "ride", "rode", "walk", "moved"}
@@ -218,29 +492,33 @@ def get_direction_constraints(all_info):
     conflicts = defaultdict(list)
 
     for info in all_info:
-        entry = info["entry"]
+        add_direction_constraints(constraints, conflicts, info)
 
-        for (a, b, dir_name) in info.get("directions", []):
-            s_key = tuple(sorted((a, b)))
-            vec = DIRECTION_WORDS[dir_name]
+    return constraints, conflicts
 
-            if (a, b) != s_key:
-                vec = (-vec[0], -vec[1])  # flip direction to match s_key
+def add_direction_constraints(constraints, conflicts, info):
+    """Adds the directions of one trip to the dicts built by get_direction_constraints."""
+    entry = info["entry"]
 
-            is_conflict = False
-            for existing_vec, existing_entry in constraints[s_key]:
-                x_conflict = existing_vec[0] != 0 and vec[0] != 0 and np.sign(existing_vec[0]) != np.sign(vec[0])
-                y_conflict = existing_vec[1] != 0 and vec[1] != 0 and np.sign(existing_vec[1]) != np.sign(vec[1])
+    for (a, b, dir_name) in info.get("directions", []):
+        s_key = tuple(sorted((a, b)))
+        vec = DIRECTION_WORDS[dir_name]
 
-                if x_conflict or y_conflict:
-                    conflicts.setdefault(s_key, [(existing_vec, existing_entry)]).append((vec, entry))
-                    is_conflict = True
-                    break
+        if (a, b) != s_key:
+            vec = (-vec[0], -vec[1])  # flip direction to match s_key
 
-            if not is_conflict:
-                constraints[s_key].append((vec, entry))
+        is_conflict = False
+        for existing_vec, existing_entry in constraints[s_key]:
+            x_conflict = existing_vec[0] != 0 and vec[0] != 0 and np.sign(existing_vec[0]) != np.sign(vec[0])
+            y_conflict = existing_vec[1] != 0 and vec[1] != 0 and np.sign(existing_vec[1]) != np.sign(vec[1])
 
-    return constraints, conflicts
+            if x_conflict or y_conflict:
+                conflicts.setdefault(s_key, [(existing_vec, existing_entry)]).append((vec, entry))
+                is_conflict = True
+                break
+
+        if not is_conflict:
+            constraints[s_key].append((vec, entry))
 
 INVERSE_DIRECTION = {
     "north": "south",
@@ -316,21 +594,77 @@ def extract_directions(sent_doc, all_locations):
 
     return directions
 
-def extract_travel_info(text, nlp, ner) -> dict:
-    info = {}
-
-    entities = ner(text)
-
-    all_locations = [ent["word"] for ent in entities if ent.get("entity_group") == "LOC"]
+def needs_ner(sent):
+    """
+    Whether the sentence could give locations or directions, the only parts
+    of extract_travel_info that use NER: locations need a travel verb
+    (TRAVEL_WORDS) and directions a direction word. Most sentences in prose
+    have neither, and extract_travel_info(sent, []) gives the same result.
+    """
+    return any(token.lemma_.lower() in TRAVEL_WORDS or token.lower_ in DIRECTION_WORDS for token in sent)
 
-    sent_doc = nlp(text)
-    # Debug text
-    # for token in sent_doc:
-    #     print(token.text, token.dep_, token.head.text, token.pos_)
+# prepositions whose objects extract_locations and extract_directions look up
+PLACE_PREPS = {"from", "to", "toward", "into"}
+POSITIONAL_VERBS = {"be", "lie"}
 
-    info["date"] = [ent.text for ent in sent_doc.ents if ent.label_ in ("DATE", "TIME")]
+def place_candidates(sent):
+    """
+    The texts extract_locations and extract_directions look up among the
+    sentence's places: objects of from/to/toward/into, objects of "of", and
+    the subject of (or word governing) "be" and "lie". NER only changes the
+    result through these, so when they are all known places the gazetteer's
+    entities stand in for NER's (which would tag them again).
+    """
+    names = set()
+    for token in sent:
+        head = token.head
+        if head.dep_ == "prep" and (head.lemma_ in PLACE_PREPS or (head.lemma_ == "of" and token.dep_ == "pobj")):
+            names.add(token.text)
+        elif token.dep_ == "nsubj" and head.lemma_.lower() in POSITIONAL_VERBS:
+            names.add(token.text)
+        # a root verb is its own head; NER never tags "is" as a place
+        if token.lemma_.lower() in POSITIONAL_VERBS and head.i != token.i:
+            names.add(head.text)
+    return names
+
+# spaCy labels that count as places for the "spacy" NER backend
+SPACY_PLACE_LABELS = {"GPE", "LOC", "FAC"}
+
+def sentence_entities(sents, batch_size=None):
+    """
+    NER output for each sentence Span, from the backend in config.NER_BACKEND,
+    always in the transformers pipeline's format.
+    """
+    if config.NER_BACKEND == "spacy":
+        return [spacy_entities(sent) for sent in sents]
+    return batch_ner([sent.text for sent in sents], models.get_ner(), batch_size)
+
+def spacy_entities(sent):
+    return [
+        {
+            "entity_group": "LOC",
+            "word": ent.text,
+            "start": ent.start_char - sent.start_char,
+            "end": ent.end_char - sent.start_char,
+            "score": 1.0,
+        }
+        for ent in sent.ents if ent.label_ in SPACY_PLACE_LABELS
+    ]
+
+def batch_ner(texts, ner, batch_size=None):
+    """
+    Runs the NER pipeline over many sentences at once instead of one forward
+    pass per sentence. Returns one entity list per text, in the same order.
+    One call at a time, since the pipeline is shared between threads.
+    """
+    if not texts:
+        return []
+    batch_size = batch_size or config.NER_BATCH_SIZE
+    with models.ner_lock:
+        return ner(list(texts), batch_size=batch_size)
 
-    locations = set()
+def extract_locations(sent_doc, all_locations):
+    locations = {}  # insertion ordered, so trips keep the order they are told in
 
     for token in sent_doc:
         if token.lemma_.lower() in TRAVEL_WORDS:
@@ -344,7 +678,7 @@ def extract_travel_info(text, nlp, ner) -> dict:
             if child.dep_ == "prep" and child.lemma_ in ("from", "to", "toward", "into"):
                 for pobj in child.children:
                     if pobj.text in all_locations:
-                        locations.add(pobj.text)
+                        locations[pobj.text] = None
 
         for child in travel_verb.children:
             if child.text.lower() in DIRECTION_WORDS:
@@ -352,9 +686,25 @@ def extract_travel_info(text, nlp, ner) -> dict:
                     if gchild.dep_ == "prep" and gchild.lemma_ in ("from", "to", "toward", "into"):
                         for pobj in gchild.children:
                             if pobj.text in all_locations:
-                                locations.add(pobj.text)
+                                locations[pobj.text] = None
 
-    info["locations"] = list(locations)
+    return list(locations)
+
+def extract_travel_info(sent_doc, entities) -> dict:
+    """
+    sent_doc is a sentence Span from the document parse (or any Doc); it is not
+    re-parsed. entities is the NER output for that sentence.
+    """
+    info = {}
+
+    all_locations = {ent["word"] for ent in entities if ent.get("entity_group") == "LOC"}
+
+    # Debug text
+    # for token in sent_doc:
+    #     print(token.text, token.dep_, token.head.text, token.pos_)
+
+    info["date"] = [ent.text for ent in sent_doc.ents if ent.label_ in ("DATE", "TIME")]
+    info["locations"] = extract_locations(sent_doc, all_locations)
     info["directions"] = extract_directions(sent_doc, all_locations)
     return info
 
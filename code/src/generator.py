@@ -1,18 +1,125 @@
-from src import extractor, solver, terrain_renderer
+from src import extractor, layout_store, solver, terrain_renderer
+from src.cache import get_result_cache
+from src.tracing import NO_TRACE, Trace
 
-def generate_map(text, with_routes=1):
-    travel_info = extractor.get_all_travel_info(text)
+# Set by src/serve.py to a process pool forked after the models are loaded;
+# extraction, solving and rendering then run there instead of holding up
+# server threads.
+_cpu_pool = None
+
+def use_process_pool(pool):
+    global _cpu_pool
+    _cpu_pool = pool
+
+def generate_map(text, with_routes=1, seed=None, layout_path=None, profile=None, cache=None, trace=None):
+    """
+    Returns the map as PNG bytes and the list of conflicting sentence pairs.
+    With a layout_path, the solve starts from the coordinates stored there and
+    the new layout is written back, so the map stays stable between edits.
+    profile picks the render quality (see terrain.RENDER_PROFILES).
+    The same text with the same options is answered from the result cache.
+    Pass a tracing.Trace to record the time and sizes of every stage.
+    """
+    if cache is None:
+        cache = get_result_cache()
+    if trace is None:
+        trace = NO_TRACE
+    gazetteer = extractor.Gazetteer.for_document()
+    with trace.stage("cache") as attributes:
+        key = cache.key(text, with_routes, profile, seed, layout_path, None if gazetteer is None else gazetteer.places)
+        cached = cache.get(key)
+        attributes["hit"] = cached is not None
+    if cached is not None:
+        return cached
+
+    with trace.stage("extract") as attributes:
+        travel_info = document_travel_info(text, gazetteer)
+        attributes["chars"] = len(text)
+        attributes["trips"] = len(travel_info)
     # extractor.pretty_print_travel_info(travel_info)
 
-    locations = extractor.get_all_locations(travel_info)
-    all_distances = extractor.get_distances(travel_info)
-    (direction_constraints, direction_conflicts) = extractor.get_direction_constraints(travel_info)
+    initial_coords = layout_store.load_layout(layout_path)
+    map_png, all_conflicts, coords = map_from_travel_info(travel_info, with_routes, initial_coords, seed, profile, trace)
+    layout_store.save_layout(layout_path, coords)
+    if map_png is not None:
+        cache.put(key, map_png, all_conflicts)
+    return map_png, all_conflicts
+
+def extract_paragraphs(paragraphs, gazetteer=None):
+    """
+    extractor.extract_paragraphs, in a worker process when a pool is set.
+    Each worker parses and runs NER with its own copy of the models (loaded
+    before the fork), so documents from several editors are extracted at
+    once instead of queueing on one process's models.ner_lock. The places
+    the worker found are added to gazetteer here.
+    """
+    if _cpu_pool is None:
+        return extractor.extract_paragraphs(paragraphs, gazetteer=gazetteer)
+    places = None if gazetteer is None else gazetteer.places
+    sentences, places = _cpu_pool.submit(_extract_in_worker, paragraphs, places).result()
+    if gazetteer is not None:
+        gazetteer.add(places)
+    return sentences
+
+def _extract_in_worker(paragraphs, places):
+    gazetteer = None if places is None else extractor.Gazetteer(places)
+    sentences = extractor.extract_paragraphs(paragraphs, gazetteer=gazetteer)
+    return sentences, None if gazetteer is None else gazetteer.places
 
-    (distances, conflicts) = solver.check_conflicts(all_distances)
+def document_travel_info(text, gazetteer=None):
+    """extractor.get_all_travel_info, extracting through extract_paragraphs above."""
+    if gazetteer is None:
+        gazetteer = extractor.Gazetteer.for_document()
+    paragraphs = extractor.split_paragraphs(text)
+    return extractor.travel_info_from_sentences(extract_paragraphs(paragraphs, gazetteer))
 
-    (coords, distances) = solver.get_coords(locations, distances, direction_constraints)
-    map_file_path = terrain_renderer.draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes)
+def map_from_travel_info(travel_info, with_routes=1, initial_coords=None, seed=None, profile=None, trace=None):
+    """
+    Runs everything after extraction. Also returns the solved coordinates so a
+    later call for the same document can pass them back as initial_coords.
+    """
+    if _cpu_pool is None:
+        return _map_from_travel_info(travel_info, with_routes, initial_coords, seed, profile, trace or NO_TRACE)
+    # the worker records into its own trace, sent back with the result
+    worker_trace = Trace(trace.name, trace.memory) if isinstance(trace, Trace) else None
+    result, worker_trace = _cpu_pool.submit(_map_in_worker, travel_info, with_routes, initial_coords, seed, profile, worker_trace).result()
+    if trace is not None:
+        trace.extend(worker_trace)
+    return result
+
+def _map_in_worker(travel_info, with_routes, initial_coords, seed, profile, trace):
+    result = _map_from_travel_info(travel_info, with_routes, initial_coords, seed, profile, trace or NO_TRACE)
+    return result, trace
+
+def _map_from_travel_info(travel_info, with_routes, initial_coords, seed, profile, trace):
+    with trace.stage("distances") as attributes:
+        locations = extractor.get_all_locations(travel_info)
+        all_distances = extractor.get_distances(travel_info)
+        attributes["locations"] = len(locations)
+        attributes["pairs"] = len(all_distances)
+    with trace.stage("directions") as attributes:
+        (direction_constraints, direction_conflicts) = extractor.get_direction_constraints(travel_info)
+        attributes["constraints"] = len(direction_constraints)
+
+    with trace.stage("conflicts") as attributes:
+        (distances, conflicts) = solver.check_conflicts(all_distances)
+        attributes["conflicts"] = len(conflicts) + len(direction_conflicts)
+
+    with trace.stage("solve") as attributes:
+        stats = {}
+        (coords, distances) = solver.get_coords(locations, distances, direction_constraints, initial_coords, seed=seed, stats=stats)
+        attributes.update({key: stats[key] for key in ("components", "residuals", "nfev", "cost")})
+    with trace.stage("render", profile=profile) as attributes:
+        map_png = terrain_renderer.draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes, profile)
+        attributes["png_bytes"] = len(map_png) if map_png else 0
 
     all_conflicts = solver.remove_exact_duplicate_pairs(solver.extract_all_conflict_sentence_pairs(conflicts, direction_conflicts))
 
-    return map_file_path, all_conflicts
+    return map_png, all_conflicts, coords
+
+def find_conflicts(travel_info):
+    """The conflicting sentence pairs alone, without solving or rendering a map."""
+    all_distances = extractor.get_distances(travel_info)
+    (_, direction_conflicts) = extractor.get_direction_constraints(travel_info)
+    (_, conflicts) = solver.check_conflicts(all_distances)
+    return solver.remove_exact_duplicate_pairs(solver.extract_all_conflict_sentence_pairs(conflicts, direction_conflicts))
@@ -0,0 +1,85 @@
+# Background map generation: submit a job, get its id back at once, poll for the result.
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from src import config
+
+class QueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"  # then "running", and "done" or "failed"
+        self.result = None
+        self.error = None
+        self.submitted = time.monotonic()
+        self.finished = None
+
+    def describe(self):
+        info = {"job_id": self.id, "status": self.status}
+        if self.error is not None:
+            info["error"] = str(self.error)
+        return info
+
+class JobQueue:
+    """
+    Runs jobs on a fixed number of worker threads. Submitting fails with
+    QueueFull while max_pending jobs are already queued or running, so a
+    burst of requests is turned away early instead of piling up. Finished
+    jobs are kept for ttl seconds so their results can be fetched, but at
+    most max_finished of them (the oldest go first), since each holds a map.
+    """
+    def __init__(self, workers=None, max_pending=None, ttl=None, max_finished=None):
+        self.workers = workers or config.JOB_WORKERS
+        self.max_pending = max_pending or config.JOB_QUEUE_SIZE
+        self.ttl = config.JOB_TTL if ttl is None else ttl
+        self.max_finished = max_finished or config.JOB_MAX_FINISHED
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="map-job")
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            self._expire()
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"{self._pending} jobs are already waiting")
+            job = Job()
+            self._jobs[job.id] = job
+            self._pending += 1
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = "running"
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            job.error = e
+            job.status = "failed"
+        with self._lock:
+            job.finished = time.monotonic()
+            self._pending -= 1
+            self._expire()
+
+    def _expire(self):
+        now = time.monotonic()
+        finished = sorted((job for job in self._jobs.values() if job.finished is not None),
+                          key=lambda job: job.finished)
+        excess = len(finished) - self.max_finished
+        for k, job in enumerate(finished):
+            if k < excess or now - job.finished > self.ttl:
+                del self._jobs[job.id]
@@ -0,0 +1,55 @@
+# Persists solved coordinates per document so later runs start from them.
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from src import config
+
+# one load-merge-write at a time, so concurrent saves of a document don't
+# drop each other's locations
+_save_lock = threading.Lock()
+
+def sidecar_path(input_file):
+    return input_file + ".layout.json"
+
+def document_path(doc_id):
+    """Layout file for a Docs document id under config.LAYOUT_DIR, or None if that's unset."""
+    if not config.LAYOUT_DIR:
+        return None
+    name = hashlib.sha1(doc_id.encode("utf-8")).hexdigest()
+    return os.path.join(config.LAYOUT_DIR, f"{name}.layout.json")
+
+def load_layout(path):
+    """Returns {location: (x, y)}; empty if there is no usable file."""
+    if not path:
+        return {}
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        return {name: (float(x), float(y)) for name, (x, y) in data.get("coords", {}).items()}
+    except (FileNotFoundError, ValueError, TypeError, AttributeError):
+        return {}
+
+def save_layout(path, coords):
+    """
+    Merges coords into the stored layout. Locations missing from this run keep
+    their old position, so they land in the same place if they come back.
+    """
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with _save_lock:
+        stored = load_layout(path)
+        stored.update({name: (float(x), float(y)) for name, (x, y) in coords.items()})
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"coords": stored}, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, path)  # atomic, so a concurrent reader never sees half a file
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -1,28 +1,94 @@
-import sys
-from src import extractor, solver, terrain_renderer_local
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from src import config, extractor, layout_store, models, solver, terrain_renderer_local
+from src.terrain import DEFAULT_PROFILE, RENDER_PROFILES
+from src.tracing import NO_TRACE, Trace, console_tracer
 
 # usage: python3 -m src.main INPUT_FILE WITH_ROUTES(1 or 0)
 # e.g. python3 -m src.main data/example1.txt 1
+# The layout is saved next to the input (INPUT_FILE.layout.json) and reused on the
+# next run so the map stays stable while the story changes; --no-layout turns this off.
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a map from a story.")
+    parser.add_argument("file", help="story text file")
+    parser.add_argument("with_routes", nargs="?", type=int, default=0, help="1 to draw routes")
+    parser.add_argument("--layout", help="layout file to start from and update (default: INPUT_FILE.layout.json)")
+    parser.add_argument("--no-layout", action="store_true", help="solve from scratch and don't save the layout")
+    parser.add_argument("--seed", type=int, help="seed for a reproducible layout")
+    parser.add_argument("--starts", type=int, default=config.SOLVER_STARTS,
+                        help="solve from this many initial guesses and keep the best (slower, steadier layouts)")
+    parser.add_argument("--profile", choices=RENDER_PROFILES, default=DEFAULT_PROFILE,
+                        help="render quality: preview is fast and small, print is large")
+    parser.add_argument("--ner", choices=models.NER_BACKENDS, default=config.NER_BACKEND,
+                        help="place recognition: transformers (most accurate), onnx (quantized, faster) or spacy (fastest)")
+    parser.add_argument("--places", help="file of known place names, one per line (they skip NER)")
+    parser.add_argument("--stream", action="store_true",
+                        help="read and extract the file a piece at a time (for book-length texts)")
+    parser.add_argument("--trace", nargs="?", const="json", choices=["json", "otel"],
+                        help="print the time and memory of every stage, as JSON or OpenTelemetry spans")
+    return parser.parse_args()
+
 def main():
-    file = sys.argv[1]
-    with_routes = int(sys.argv[2]) if len(sys.argv) == 3 else 0
-    try:
-        with open(file, "r") as f:
-            text = f.read()
-    except FileNotFoundError:
+    args = parse_args()
+    file = args.file
+    with_routes = args.with_routes
+    if not os.path.isfile(file):
         print(f"Error: File '{file}' not found.")
+        return
+
+    models.use_ner_backend(args.ner)
+    extractor.use_parse_processes(config.SPACY_N_PROCESS)
+    if args.places:
+        config.PLACES_FILE = args.places
+    layout_path = None if args.no_layout else (args.layout or layout_store.sidecar_path(file))
+    trace = Trace("main", memory=True) if args.trace else NO_TRACE
 
-    travel_info = extractor.get_all_travel_info(text)
-    extractor.pretty_print_travel_info(travel_info)
+    if args.stream:
+        # trips are folded into the summary as they are found, so memory
+        # doesn't grow with the length of the file
+        with trace.stage("extract") as attributes:
+            summary = extractor.TravelSummary()
+            with open(file, "r") as f:
+                for trip in extractor.iter_travel_info(extractor.iter_paragraphs(f)):
+                    summary.add(trip)
+            attributes["trips"] = summary.trips
+        locations = sorted(summary.locations)
+        all_distances = summary.distances
+        (direction_constraints, direction_conflicts) = (summary.direction_constraints, summary.direction_conflicts)
+    else:
+        with open(file, "r") as f:
+            text = f.read()
+        with trace.stage("extract") as attributes:
+            travel_info = extractor.get_all_travel_info(text)
+            attributes["chars"] = len(text)
+            attributes["trips"] = len(travel_info)
+        extractor.pretty_print_travel_info(travel_info)
 
-    locations = extractor.get_all_locations(travel_info)
-    all_distances = extractor.get_distances(travel_info)
-    (direction_constraints, direction_conflicts) = extractor.get_direction_constraints(travel_info)
+        with trace.stage("distances") as attributes:
+            locations = extractor.get_all_locations(travel_info)
+            all_distances = extractor.get_distances(travel_info)
+            attributes["locations"] = len(locations)
+            attributes["pairs"] = len(all_distances)
+        with trace.stage("directions") as attributes:
+            (direction_constraints, direction_conflicts) = extractor.get_direction_constraints(travel_info)
+            attributes["constraints"] = len(direction_constraints)
 
-    (distances, conflicts) = solver.check_conflicts(all_distances)
+    with trace.stage("conflicts") as attributes:
+        (distances, conflicts) = solver.check_conflicts(all_distances)
+        attributes["conflicts"] = len(conflicts) + len(direction_conflicts)
 
-    (coords, distances) = solver.get_coords(locations, distances, direction_constraints)
-    map_file_path = terrain_renderer_local.draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes)
+    initial_coords = layout_store.load_layout(layout_path)
+    with trace.stage("solve") as attributes, ProcessPoolExecutor(config.SOLVER_WORKERS) as pool:
+        # only started if the solve is big enough to use it
+        solver.use_process_pool(pool)
+        stats = {}
+        (coords, distances) = solver.get_coords(locations, distances, direction_constraints, initial_coords, starts=args.starts, seed=args.seed, stats=stats)
+        attributes.update({key: stats[key] for key in ("components", "residuals", "nfev", "cost")})
+    layout_store.save_layout(layout_path, coords)
+    with trace.stage("render", profile=args.profile):
+        map_file_path = terrain_renderer_local.draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes, args.profile)
 
     all_conflicts = solver.remove_exact_duplicate_pairs(solver.extract_all_conflict_sentence_pairs(conflicts, direction_conflicts))
     print("Conflicts: ")
@@ -30,7 +96,12 @@ def main():
         print(all_conflicts)
     else:
         print("None")
+
+    if args.trace == "json":
+        print(json.dumps(trace.to_dict(), indent=2))
+    elif args.trace == "otel":
+        trace.export_otel(console_tracer())
     return map_file_path, all_conflicts
 
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,142 @@
+# Process-wide registry for the spaCy and NER models.
+# Loading BERT-large takes seconds and ~1GB of RAM, so every caller shares one copy.
+import os
+import threading
+import spacy
+from transformers import AutoTokenizer, pipeline, logging
+from src import config
+
+logging.set_verbosity_error()
+
+_lock = threading.RLock()  # the spaCy NER backend loads nlp while holding it
+_models = {}
+_errors = {}
+# The NER pipeline is shared by the threads of a process, and its fast
+# tokenizer fails on concurrent calls ("Already borrowed"), so calls into it
+# take this lock (see extractor.batch_ner). Under src/serve.py extraction
+# runs in the worker processes, each with its own pipeline and lock.
+ner_lock = threading.Lock()
+
+def _load_nlp():
+    return spacy.load(config.SPACY_MODEL)
+
+def _load_transformers_ner():
+    return pipeline(
+        "ner",
+        model=config.NER_MODEL,
+        aggregation_strategy="first"
+    )
+
+def _load_onnx_ner():
+    # The same model exported to ONNX and quantized to int8 (dynamic
+    # quantization, no calibration data needed). The export is done once and
+    # kept in config.NER_ONNX_DIR.
+    from optimum.onnxruntime import ORTModelForTokenClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    path = config.NER_ONNX_DIR
+    if not os.path.exists(os.path.join(path, "model_quantized.onnx")):
+        model = ORTModelForTokenClassification.from_pretrained(config.NER_MODEL, export=True)
+        model.save_pretrained(path)
+        AutoTokenizer.from_pretrained(config.NER_MODEL).save_pretrained(path)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(AutoQuantizationConfig.avx2(is_static=False, per_channel=False), save_dir=path)
+    model = ORTModelForTokenClassification.from_pretrained(path, file_name="model_quantized.onnx")
+    return pipeline(
+        "ner",
+        model=model,
+        tokenizer=AutoTokenizer.from_pretrained(path),
+        aggregation_strategy="first"
+    )
+
+def _load_spacy_ner():
+    # entities come from the parse the extractor already runs (see extractor.sentence_entities)
+    return get_nlp()
+
+NER_BACKENDS = {
+    "transformers": _load_transformers_ner,
+    "onnx": _load_onnx_ner,
+    "spacy": _load_spacy_ner,
+}
+
+def _load_ner():
+    if config.NER_BACKEND not in NER_BACKENDS:
+        raise ValueError(f"unknown NER backend {config.NER_BACKEND!r}, use one of {', '.join(NER_BACKENDS)}")
+    return NER_BACKENDS[config.NER_BACKEND]()
+
+_LOADERS = {
+    "nlp": _load_nlp,
+    "ner": _load_ner,
+}
+
+def _get(name):
+    model = _models.get(name)
+    if model is not None:
+        return model
+    with _lock:
+        # another thread may have finished loading while we waited
+        if name not in _models:
+            try:
+                _models[name] = _LOADERS[name]()
+                _errors.pop(name, None)
+            except Exception as e:
+                _errors[name] = repr(e)
+                raise
+        return _models[name]
+
+def get_nlp():
+    return _get("nlp")
+
+def get_ner():
+    return _get("ner")
+
+def set_model(name, model):
+    """Uses the given object instead of loading the model (e.g. a stub NER for benchmarks)."""
+    with _lock:
+        _models[name] = model
+        _errors.pop(name, None)
+
+def unload(name):
+    """Forgets a model so the next use loads it again (e.g. after switching NER backend)."""
+    with _lock:
+        _models.pop(name, None)
+        _errors.pop(name, None)
+
+def use_ner_backend(name):
+    if name not in NER_BACKENDS:
+        raise ValueError(f"unknown NER backend {name!r}, use one of {', '.join(NER_BACKENDS)}")
+    config.NER_BACKEND = name
+    unload("ner")
+
+def warm_up():
+    """
+    Loads every model up front (e.g. at server start) so the first request
+    doesn't pay for it.
+    """
+    for name in _LOADERS:
+        _get(name)
+
+def fingerprint():
+    """
+    Identifies the models and extraction rules in use. Cached extraction
+    results are only valid for the same fingerprint.
+    """
+    try:
+        spacy_version = spacy.util.get_package_version(config.SPACY_MODEL)
+    except Exception:
+        spacy_version = None
+    ner = config.NER_MODEL if config.NER_BACKEND == "transformers" else f"{config.NER_BACKEND}:{config.NER_MODEL}"
+    return f"{config.SPACY_MODEL}-{spacy_version}|{ner}|{config.EXTRACTOR_VERSION}"
+
+def is_ready():
+    return all(name in _models for name in _LOADERS)
+
+def status():
+    return {
+        "ready": is_ready(),
+        "models": {
+            name: "loaded" if name in _models else ("error" if name in _errors else "not loaded")
+            for name in _LOADERS
+        },
+        "errors": dict(_errors),
+    }
@@ -0,0 +1,49 @@
+# Production server for the Google Docs plug-in; src/app.py's __main__ is the development server.
+#
+# Models are loaded first, then a pool of worker processes is forked so they
+# share the loaded memory copy-on-write. Requests are answered by uvicorn on a
+# pool of threads in this process, which keeps the document sessions and the
+# job queue in one place; extraction (parsing and NER), solving and rendering,
+# the CPU-bound stages, are sent to the worker processes, each using its own
+# copy of the models (see generator.use_process_pool). Each worker has its
+# own in-memory extraction cache; set STORY_MAP_CACHE_DB to share one.
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import uvicorn
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from src import config, generator, models
+from src.app import app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the story map API.")
+    parser.add_argument("--host", default=config.SERVE_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVE_PORT)
+    parser.add_argument("--threads", type=int, default=config.SERVE_THREADS, help="requests handled at once")
+    parser.add_argument("--processes", type=int, default=config.SERVE_PROCESSES,
+                        help="processes for extraction, solving and rendering (default: one per CPU)")
+    parser.add_argument("--ner", choices=models.NER_BACKENDS, default=config.NER_BACKEND,
+                        help="NER backend (see config.NER_BACKEND)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    models.use_ner_backend(args.ner)
+    models.warm_up()
+
+    pool = ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context("fork"))
+    # fork every worker now, before the server has started any threads
+    pool.submit(int).result()
+    generator.use_process_pool(pool)
+
+    try:
+        uvicorn.run(WSGIMiddleware(app, workers=args.threads), host=args.host, port=args.port)
+    finally:
+        pool.shutdown()
+
+if __name__ == "__main__":
+    main()
+
+# run with
+# python -m src.serve --processes 4
+# and use the endpoints as described in src/app.py
@@ -0,0 +1,71 @@
+# Per-document state for incremental map generation (see /generate_map_incremental in app.py).
+import hashlib
+import threading
+from collections import OrderedDict
+from src import config, extractor, generator, layout_store
+
+class DocumentSession:
+    """
+    The last known paragraphs of one document, their extracted sentences, the
+    places found in it so far and the last solved layout. Paragraph indices
+    are the ones the client uses, blank paragraphs included, so edits can be
+    addressed by range.
+    """
+    def __init__(self, doc_id):
+        self.doc_id = doc_id
+        self.paragraphs = []
+        self.sentences = []  # one list of (text, sent_info) pairs per paragraph
+        self.gazetteer = extractor.Gazetteer.for_document()
+        self.layout_path = layout_store.document_path(doc_id)
+        self.coords = layout_store.load_layout(self.layout_path)
+        self.lock = threading.Lock()
+
+    def replace(self, paragraphs):
+        self.paragraphs = list(paragraphs)
+        self.sentences = generator.extract_paragraphs(self.paragraphs, self.gazetteer)
+
+    def apply_edit(self, start, end, paragraphs):
+        """Replaces paragraphs[start:end] and re-extracts only the new ones."""
+        if not (0 <= start <= end <= len(self.paragraphs)):
+            raise ValueError(f"edit range {start}:{end} is outside a document of {len(self.paragraphs)} paragraphs")
+        paragraphs = list(paragraphs)
+        self.paragraphs[start:end] = paragraphs
+        self.sentences[start:end] = generator.extract_paragraphs(paragraphs, self.gazetteer)
+
+    def version(self):
+        """Hex SHA-256 of the paragraphs joined by newlines (documentVersion in Code.js)."""
+        return hashlib.sha256("\n".join(self.paragraphs).encode("utf-8")).hexdigest()
+
+    def travel_info(self):
+        return extractor.travel_info_from_sentences(self.sentences)
+
+    def update_layout(self, coords):
+        # merged like save_layout: a location deleted and added back within
+        # the session starts from where it was
+        self.coords = {**self.coords, **coords}
+        layout_store.save_layout(self.layout_path, coords)
+
+class SessionStore:
+    """Keeps the most recently used documents, up to config.MAX_SESSIONS."""
+    def __init__(self, max_sessions=None):
+        self.max_sessions = max_sessions or config.MAX_SESSIONS
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doc_id):
+        with self._lock:
+            session = self._sessions.get(doc_id)
+            if session is not None:
+                self._sessions.move_to_end(doc_id)
+            return session
+
+    def get_or_create(self, doc_id):
+        with self._lock:
+            session = self._sessions.get(doc_id)
+            if session is None:
+                session = DocumentSession(doc_id)
+                self._sessions[doc_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(doc_id)
+            return session
@@ -1,7 +1,31 @@
+import time
 import numpy as np
 from scipy.optimize import least_squares
-
-def get_coords(locations, distances, direction_constraints):
+from collections import defaultdict
+from scipy.sparse import coo_matrix, csgraph
+from scipy.spatial import cKDTree
+from src import config
+
+MIN_DIST = 15.0  # change depending on map scale
+# Residual slots reserved for overlapping pairs, per location. Only pairs closer
+# than MIN_DIST contribute, so the deepest overlaps fill these and the rest are 0.
+REPULSION_SLOTS_PER_LOCATION = 8
+SPARSE_JACOBIAN_MIN_LOCATIONS = 10  # below this a dense Jacobian is just as fast
+
+# Set by src/main.py to a process pool kept for the whole run. Servers leave
+# it unset so no request forks a process (under src/serve.py the solve
+# already runs in one of its worker processes).
+_pool = None
+
+def use_process_pool(pool):
+    global _pool
+    _pool = pool
+
+def build_problem(locations, distances, direction_constraints):
+    """
+    Turns the constraints into flat index arrays so the residuals and their
+    Jacobian can be evaluated with NumPy instead of Python loops.
+    """
     # Map location names to indices
     loc_index = {loc: i for i, loc in enumerate(locations)}
     distance_lookup = {}
@@ -11,74 +35,332 @@ def get_coords(locations, distances, direction_constraints):
         distance_lookup[(l2, l1)] = d
     avg_distance = np.mean(list(distance_lookup.values())) if distance_lookup else 1.0
 
-    def residuals(coords):
-        coords = coords.reshape(-1, 2)
-        res = []
-        # Distance matching residuals
-        for (l1, l2), dist_list in distances.items():
-            d = dist_list[0]
-            i, j = loc_index[l1], loc_index[l2]
-            xi, yi = coords[i]
-            xj, yj = coords[j]
-            res.append(np.sqrt((xi - xj)**2 + (yi - yj)**2) - d)
-
-        for (a, b), vec_list in direction_constraints.items():
-            i, j = loc_index[a], loc_index[b]
-            xi, yi = coords[i]
-            xj, yj = coords[j]
-            dx, dy = xj - xi, yj - yi
-            norm = np.sqrt(dx*dx + dy*dy) + 1e-6
-            weight = distance_lookup.get((a, b), avg_distance)
-
-            for vec, _ in vec_list:  # iterate over all valid vectors
-                res.append(weight * ((dx / norm) - vec[0]))
-                res.append(weight * ((dy / norm) - vec[1]))
-
-        # Repulsion residuals (soft constraint)
-        MIN_DIST = 15.0  # change depending on map scale
-        for i in range(len(coords)):
-            for j in range(i + 1, len(coords)):
-                dx = coords[i, 0] - coords[j, 0]
-                dy = coords[i, 1] - coords[j, 1]
-                dist = np.sqrt(dx * dx + dy * dy) + 1e-6
-                # Penalize overlap more strongly the closer they get while keeping residual length constant
-                res.append(max(0.0, (MIN_DIST - dist) / MIN_DIST))
-
-        # This section encourages the points to not be in a straight line
-        if len(coords) >= 3:
-            xs = coords[:, 0]
-            ys = coords[:, 1]
-            var_x = np.var(xs)
-            var_y = np.var(ys)
-
-            # If variance along one axis dominates (line-like), penalize it
-            if var_x > 1e-6 and var_y > 1e-6:
-                ratio = max(var_x, var_y) / (min(var_x, var_y) + 1e-6)
-                res.append(0.01 * ratio)
-
-        dirs = np.array([vec for vec_list in direction_constraints.values() for vec, _ in vec_list])
-        if len(dirs) > 1:
-            mean_dir = np.mean(dirs, axis=0)
-            spread = np.mean(np.linalg.norm(dirs - mean_dir, axis=1))
-            res.append(0.01 / (spread + 1e-3))
-
-        return res
-
-    # Initial guess
-    x0 = (np.random.rand(len(locations) * 2) - 0.5) * 500
-
+    # Distance matching
+    dist_pairs = [(loc_index[l1], loc_index[l2], dist_list[0]) for (l1, l2), dist_list in distances.items()]
+
+    # Direction matching, one row per valid vector
+    dir_rows = []
+    for (a, b), vec_list in direction_constraints.items():
+        weight = distance_lookup.get((a, b), avg_distance)
+        for vec, _ in vec_list:
+            dir_rows.append((loc_index[a], loc_index[b], vec[0], vec[1], weight))
+
+    n = len(locations)
+
+    # Encourages directions not to all point the same way; doesn't depend on the coordinates
+    spread_term = None
+    dirs = np.array([vec for vec_list in direction_constraints.values() for vec, _ in vec_list])
+    if len(dirs) > 1:
+        mean_dir = np.mean(dirs, axis=0)
+        spread = np.mean(np.linalg.norm(dirs - mean_dir, axis=1))
+        spread_term = 0.01 / (spread + 1e-3)
+
+    dist_arr = np.array(dist_pairs, dtype=float).reshape(-1, 3)
+    dir_arr = np.array(dir_rows, dtype=float).reshape(-1, 5)
+    return {
+        "n": n,
+        "dist_i": dist_arr[:, 0].astype(int),
+        "dist_j": dist_arr[:, 1].astype(int),
+        "dist_d": dist_arr[:, 2],
+        "dir_i": dir_arr[:, 0].astype(int),
+        "dir_j": dir_arr[:, 1].astype(int),
+        "dir_v": dir_arr[:, 2:4],
+        "dir_w": dir_arr[:, 4],
+        "repulsion_slots": min(n * (n - 1) // 2, REPULSION_SLOTS_PER_LOCATION * n),
+        "line_term": n >= 3,
+        "spread_term": spread_term,
+    }
+
+def residual_count(problem):
+    return (len(problem["dist_d"]) + 2 * len(problem["dir_w"]) + problem["repulsion_slots"]
+            + int(problem["line_term"]) + int(problem["spread_term"] is not None))
+
+def _line_ratio(coords):
+    # If variance along one axis dominates (line-like), penalize it
+    var = np.var(coords, axis=0)
+    if var[0] > 1e-6 and var[1] > 1e-6:
+        big = int(np.argmax(var))
+        return var[big] / (var[1 - big] + 1e-6), var, big
+    return 0.0, var, None
+
+def _overlapping_pairs(coords, problem):
+    """
+    Pairs closer than MIN_DIST, found with a KD-tree instead of comparing every
+    pair. Returns (i, j, diff, length), at most repulsion_slots of them.
+    """
+    slots = problem["repulsion_slots"]
+    if slots == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, np.zeros((0, 2)), np.zeros(0)
+    pairs = cKDTree(coords).query_pairs(MIN_DIST - 1e-6, output_type="ndarray")
+    i, j = pairs[:, 0], pairs[:, 1]
+    diff = coords[i] - coords[j]
+    length = np.sqrt(np.sum(diff * diff, axis=1))
+    if len(i) > slots:
+        # keep the deepest overlaps
+        keep = np.argpartition(length, slots - 1)[:slots]
+        i, j, diff, length = i[keep], j[keep], diff[keep], length[keep]
+    return i, j, diff, length
+
+def residuals(x, problem):
+    coords = x.reshape(-1, 2)
+    parts = []
+
+    # Distance matching residuals
+    diff = coords[problem["dist_i"]] - coords[problem["dist_j"]]
+    parts.append(np.sqrt(np.sum(diff * diff, axis=1)) - problem["dist_d"])
+
+    # Direction residuals: unit vector a→b against each expected vector
+    diff = coords[problem["dir_j"]] - coords[problem["dir_i"]]
+    norm = np.sqrt(np.sum(diff * diff, axis=1)) + 1e-6
+    unit = diff / norm[:, None]
+    parts.append((problem["dir_w"][:, None] * (unit - problem["dir_v"])).ravel())
+
+    # Repulsion residuals (soft constraint), constant length
+    _, _, _, length = _overlapping_pairs(coords, problem)
+    repulsion = np.zeros(problem["repulsion_slots"])
+    # Penalize overlap more strongly the closer they get
+    repulsion[:len(length)] = np.maximum(0.0, (MIN_DIST - (length + 1e-6)) / MIN_DIST)
+    parts.append(repulsion)
+
+    # This section encourages the points to not be in a straight line
+    if problem["line_term"]:
+        parts.append([0.01 * _line_ratio(coords)[0]])
+
+    if problem["spread_term"] is not None:
+        parts.append([problem["spread_term"]])
+
+    return np.concatenate(parts)
+
+def jacobian(x, problem):
+    """Analytic Jacobian of residuals(); sparse for large problems."""
+    coords = x.reshape(-1, 2)
+    rows, cols, vals = [], [], []
+    offset = 0
+
+    def add(row, i, j, g):
+        # g[:, k] = d(residual)/d(diff_k) where diff = coords[i] - coords[j]
+        for k in (0, 1):
+            rows.extend((row, row))
+            cols.extend((2 * i + k, 2 * j + k))
+            vals.extend((g[:, k], -g[:, k]))
+
+    # Distance: d|diff|/d(diff) = diff / |diff|
+    i, j = problem["dist_i"], problem["dist_j"]
+    diff = coords[i] - coords[j]
+    length = np.sqrt(np.sum(diff * diff, axis=1))
+    safe = np.where(length > 0, length, 1.0)
+    add(offset + np.arange(len(i)), i, j, np.where(length[:, None] > 0, diff / safe[:, None], 0.0))
+    offset += len(i)
+
+    # Direction: d(diff/norm)/d(diff) with diff = coords[b] - coords[a]
+    i, j, w = problem["dir_j"], problem["dir_i"], problem["dir_w"]
+    diff = coords[i] - coords[j]
+    length = np.sqrt(np.sum(diff * diff, axis=1))
+    norm = length + 1e-6
+    safe = np.where(length > 0, length, 1.0)
+    outer = diff[:, 0] * diff[:, 1] / (safe * norm * norm)
+    dxx = 1.0 / norm - diff[:, 0] ** 2 / (safe * norm * norm)
+    dyy = 1.0 / norm - diff[:, 1] ** 2 / (safe * norm * norm)
+    row_x = offset + 2 * np.arange(len(i))
+    add(row_x, i, j, w[:, None] * np.column_stack((dxx, -outer)))
+    add(row_x + 1, i, j, w[:, None] * np.column_stack((-outer, dyy)))
+    offset += 2 * len(i)
+
+    # Repulsion: same pairs, in the same slots, as residuals()
+    i, j, diff, length = _overlapping_pairs(coords, problem)
+    safe = np.where(length > 0, length, 1.0)
+    g = np.where(length[:, None] > 0, -diff / (safe[:, None] * MIN_DIST), 0.0)
+    add(offset + np.arange(len(i)), i, j, g)
+    offset += problem["repulsion_slots"]
+
+    line_row = None
+    if problem["line_term"]:
+        line_row = offset
+        offset += 1
+    if problem["spread_term"] is not None:
+        offset += 1
+
+    n = problem["n"]
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+    vals = np.concatenate(vals) if vals else np.zeros(0)
+
+    if line_row is not None:
+        ratio, var, big = _line_ratio(coords)
+        if big is not None:
+            small = 1 - big
+            centred = coords - coords.mean(axis=0)
+            dvar = 2 * centred / n  # d var_k / d coord_k
+            grad = np.zeros_like(coords)
+            grad[:, big] = dvar[:, big] / (var[small] + 1e-6)
+            grad[:, small] = -var[big] * dvar[:, small] / (var[small] + 1e-6) ** 2
+            rows = np.concatenate((rows, np.full(2 * n, line_row)))
+            cols = np.concatenate((cols, np.arange(2 * n)))
+            vals = np.concatenate((vals, 0.01 * grad.ravel()))
+
+    jac = coo_matrix((vals, (rows, cols)), shape=(offset, 2 * n))
+    if n >= SPARSE_JACOBIAN_MIN_LOCATIONS:
+        return jac.tocsr()
+    return jac.toarray()
+
+def initial_guess(locations, distances, rng, initial_coords=None):
+    x0 = (rng.random(len(locations) * 2) - 0.5) * 500
 
     if len(locations) > 1:
         d = distances.get((locations[0], locations[1]),
                       distances.get((locations[1], locations[0]), (1.0, None)))
         d = d[0]
-        theta = np.random.rand() * 2 * np.pi
+        theta = rng.random() * 2 * np.pi
         x0[2], x0[3] = d * np.cos(theta), d * np.sin(theta)
 
-    result = least_squares(residuals, x0)
+    if initial_coords:
+        known = [initial_coords[loc] for loc in locations if loc in initial_coords]
+        if known:
+            # new locations scatter around the previous layout rather than the origin
+            x0 += np.tile(np.mean(known, axis=0), len(locations))
+        for i, loc in enumerate(locations):
+            if loc in initial_coords:
+                x0[2 * i], x0[2 * i + 1] = initial_coords[loc]
+
+    return x0
+
+def _solve_start(problem, x0):
+    # module level so it can run in a worker process
+    start = time.perf_counter()
+    if residual_count(problem) == 0:
+        return x0, {"cost": 0.0, "nfev": 0, "njev": 0, "status": None, "seconds": 0.0}
+    result = least_squares(residuals, x0, jac=jacobian, args=(problem,))
+    return result.x, {
+        "cost": float(result.cost),
+        "nfev": int(result.nfev),
+        "njev": int(result.njev or 0),
+        "status": int(result.status),
+        "seconds": time.perf_counter() - start,
+    }
+
+def solve(tasks, workers=None):
+    """
+    Runs one least-squares solve per (problem, x0) task and returns their
+    (x, diagnostics) in order. Big enough batches go over the pool set with
+    use_process_pool unless workers is 1; otherwise they run one by one.
+    """
+    work = sum(residual_count(problem) for problem, _ in tasks)
+    if _pool is not None and len(tasks) > 1 and workers != 1 and work >= config.SOLVER_PARALLEL_MIN_RESIDUALS:
+        return list(_pool.map(_solve_start, *zip(*tasks)))
+    return [_solve_start(problem, x0) for problem, x0 in tasks]
 
-    coords_array = result.x.reshape(-1, 2)
-    coords = {name: tuple(coord) for name, coord in zip(locations, coords_array)}
+def connected_components(locations, distances, direction_constraints):
+    """
+    Groups locations that are linked, directly or not, by a distance or a
+    direction. Each group can be laid out on its own. Groups come biggest
+    first, and keep the order of locations within them.
+    """
+    if not locations:
+        return []
+    loc_index = {loc: i for i, loc in enumerate(locations)}
+    edges = [(loc_index[a], loc_index[b]) for (a, b) in list(distances) + list(direction_constraints)]
+    rows = [i for i, _ in edges]
+    cols = [j for _, j in edges]
+    graph = coo_matrix((np.ones(len(edges)), (rows, cols)), shape=(len(locations), len(locations)))
+    _, labels = csgraph.connected_components(graph, directed=False)
+
+    groups = defaultdict(list)
+    for loc, label in zip(locations, labels):
+        groups[label].append(loc)
+    return sorted(groups.values(), key=lambda group: (-len(group), group[0]))
+
+def pack_components(blocks, fixed=()):
+    """
+    Translates each component's coordinates (an (n, 2) array) so their
+    bounding boxes sit in rows without overlapping. The blocks whose indices
+    are in fixed stay where they are, and the others go in rows past their
+    largest y (above them on the map, which is drawn with y pointing up).
+    """
+    movable = [k for k in range(len(blocks)) if k not in fixed]
+    if not movable:
+        return list(blocks)
+    extents = [blocks[k].max(axis=0) - blocks[k].min(axis=0) for k in movable]
+    gap = max(2 * MIN_DIST, 0.1 * max(extent.max() for extent in extents))
+    row_width = max(np.sqrt(sum((w + gap) * (h + gap) for w, h in extents)), max(w for w, _ in extents))
+
+    left = top = 0.0
+    if fixed:
+        placed = np.vstack([blocks[k] for k in fixed])
+        left, top = placed[:, 0].min(), placed[:, 1].max() + gap
+
+    packed = list(blocks)
+    x, y, row_height = left, top, 0.0
+    for k, (w, h) in zip(movable, extents):
+        if x > left and x - left + w > row_width:
+            x, y, row_height = left, y + row_height + gap, 0.0
+        packed[k] = blocks[k] - blocks[k].min(axis=0) + (x, y)
+        x += w + gap
+        row_height = max(row_height, h)
+    return packed
+
+def get_coords(locations, distances, direction_constraints, initial_coords=None,
+               starts=None, seed=None, workers=None, stats=None):
+    """
+    initial_coords optionally maps location names to a previous (x, y); those
+    locations start from there (a warm start) and only new ones start randomly.
+
+    Unconnected groups of locations are solved separately, and the new ones
+    packed above those from the stored layout. starts > 1 solves every group
+    from that many initial guesses (in parallel, see solve) and keeps the best. With a seed the result is
+    reproducible. If a stats dict is passed it is filled with the solver
+    diagnostics.
+    """
+    starts = starts or config.SOLVER_STARTS
+    seed = config.SOLVER_SEED if seed is None else seed
+    workers = config.SOLVER_WORKERS if workers is None else workers
+
+    groups = connected_components(locations, distances, direction_constraints)
+    root = np.random.SeedSequence(seed)
+    seeds = [root] if len(groups) == 1 else root.spawn(len(groups))
+
+    tasks, owners, problems = [], [], []
+    for k, (group, group_seed) in enumerate(zip(groups, seeds)):
+        members = set(group)
+        group_distances = {pair: d for pair, d in distances.items() if pair[0] in members}
+        group_directions = {pair: v for pair, v in direction_constraints.items() if pair[0] in members}
+        problem = build_problem(group, group_distances, group_directions)
+        problems.append(problem)
+        # Initial guesses, one independent stream per start
+        for start_seed in group_seed.spawn(starts):
+            rng = np.random.default_rng(start_seed)
+            tasks.append((problem, initial_guess(group, group_distances, rng, initial_coords)))
+            owners.append(k)
+
+    results = solve(tasks, workers)
+
+    blocks, best_starts, diagnostics = [], [], []
+    for k in range(len(groups)):
+        mine = [r for r, owner in zip(results, owners) if owner == k]
+        best = min(range(len(mine)), key=lambda s: mine[s][1]["cost"])  # earliest start wins ties
+        blocks.append(mine[best][0].reshape(-1, 2))
+        best_starts.append(best)
+        diagnostics += [dict(d, component=k) for _, d in mine]
+    if len(blocks) > 1:
+        # groups started from a stored layout stay put, so the map stays
+        # stable between edits; only groups with no stored location move
+        fixed = {k for k, group in enumerate(groups) if initial_coords and any(loc in initial_coords for loc in group)}
+        blocks = pack_components(blocks, fixed)
+
+    if stats is not None:
+        stats.update({
+            "locations": len(locations),
+            "components": len(groups),
+            "residuals": sum(residual_count(problem) for problem in problems),
+            "best_starts": best_starts,
+            "cost": sum(diagnostics[k * starts + best]["cost"] for k, best in enumerate(best_starts)),
+            "nfev": sum(d["nfev"] for d in diagnostics),
+            "starts": diagnostics,
+        })
+
+    coords = {}
+    for group, block in zip(groups, blocks):
+        coords.update({name: tuple(coord) for name, coord in zip(group, block)})
 
     updated_distances = {}
 
@@ -0,0 +1,121 @@
+# Shared terrain helpers for terrain_renderer.py and terrain_renderer_local.py.
+import numpy as np
+
+# Ken Perlin's reference permutation, the same table the noise package uses,
+# so perlin_noise_grid() reproduces noise.pnoise2 and today's maps.
+PERLIN_PERMUTATION = np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225,
+    140, 36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148, 247,
+    120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32, 57,
+    177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175, 74,
+    165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122,
+    60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54,
+    65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169,
+    200, 196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3,
+    64, 52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85,
+    212, 207, 206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170,
+    213, 119, 248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43,
+    172, 9, 129, 22, 39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185,
+    112, 104, 218, 246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191,
+    179, 162, 241, 81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31,
+    181, 199, 106, 157, 184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150,
+    254, 138, 236, 205, 93, 222, 114, 67, 29, 24, 72, 243, 141, 128, 195,
+    78, 66, 215, 61, 156, 180,
+], dtype=np.intp)
+
+# noise.pnoise2 gradients (the x, y columns of its GRAD3 table)
+_GRADIENTS = np.array([
+    (1, 1), (-1, 1), (1, -1), (-1, -1),
+    (1, 0), (-1, 0), (1, 0), (-1, 0),
+    (0, 1), (0, -1), (0, 1), (0, -1),
+    (1, 0), (-1, 0), (0, -1), (0, 1),
+], dtype=np.float32)
+
+def _permutation(seed):
+    if seed is None:
+        perm = PERLIN_PERMUTATION
+    else:
+        perm = np.random.default_rng(seed).permutation(256)
+    return np.concatenate((perm, perm))
+
+def _axis(coords, repeat):
+    # integer cell, next cell (both wrapped) and the fractional part, as in noise2()
+    cell = np.floor(np.fmod(coords, np.float32(repeat))).astype(np.intp)
+    next_cell = np.fmod(cell + 1, repeat).astype(np.intp)
+    frac = coords - np.floor(coords)
+    fade = frac * frac * frac * (frac * (frac * 6 - 15) + 10)
+    return cell & 255, next_cell & 255, frac, fade
+
+def _grad(grad_x, grad_y, hashed, x, y):
+    return x * grad_x[hashed] + y * grad_y[hashed]
+
+def perlin_noise_grid(width, height, scale=0.02, seed=None, repeat=1024):
+    """
+    2-D Perlin noise on a height x width grid: element [y, x] equals
+    noise.pnoise2(x * scale, y * scale), computed with NumPy in one pass
+    instead of one call per pixel. A seed picks a different permutation.
+    """
+    perm = _permutation(seed)
+    xs = (np.arange(width) * scale).astype(np.float32)[None, :]
+    ys = (np.arange(height) * scale).astype(np.float32)[:, None]
+    i, ii, x, fx = _axis(xs, repeat)
+    j, jj, y, fy = _axis(ys, repeat)
+
+    a = perm[i]
+    b = perm[ii]
+    aa, ab = perm[a + j], perm[a + jj]
+    ba, bb = perm[b + j], perm[b + jj]
+
+    # gradient components per hash value, looked up once per corner
+    grad_x = _GRADIENTS[perm & 15, 0]
+    grad_y = _GRADIENTS[perm & 15, 1]
+    one = np.float32(1)
+    g_aa = _grad(grad_x, grad_y, aa, x, y)
+    g_ba = _grad(grad_x, grad_y, ba, x - one, y)
+    g_ab = _grad(grad_x, grad_y, ab, x, y - one)
+    g_bb = _grad(grad_x, grad_y, bb, x - one, y - one)
+    bottom = g_aa + fx * (g_ba - g_aa)
+    top = g_ab + fx * (g_bb - g_ab)
+    return bottom + fy * (top - bottom)
+
+def gaussian_heightmap(points, width, height, sigma, cutoff=None, dtype=np.float32):
+    """
+    Sum of one Gaussian hill per (x, y) point on a height x width grid.
+
+    A 2-D Gaussian is the product of two 1-D ones, so the whole map is a
+    single (height, n) @ (n, width) product of per-axis profiles instead of a
+    full-frame distance array per point. With a cutoff (in sigmas) each hill
+    is clipped to a box of that half-width, which keeps many small hills cheap.
+    """
+    pts = np.asarray(list(points), dtype=dtype).reshape(-1, 2)
+    if len(pts) == 0:
+        return np.zeros((height, width), dtype=dtype)
+
+    def profiles(size, centres):
+        offsets = np.arange(size, dtype=dtype)[None, :] - centres[:, None]
+        g = np.exp(-(offsets * offsets) / dtype(2 * sigma * sigma))
+        if cutoff is not None:
+            g[np.abs(offsets) > cutoff * sigma] = 0
+        return g
+
+    gx = profiles(width, pts[:, 0])   # (n, width)
+    gy = profiles(height, pts[:, 1])  # (n, height)
+    return gy.T @ gx
+
+# Grid size, output DPI and what gets drawn. "standard" is the original
+# 800x600 render; the others scale its geometry so maps look alike.
+RENDER_PROFILES = {
+    "preview": {"size": (400, 300), "dpi": 72, "labels": True, "routes": False},
+    "standard": {"size": (800, 600), "dpi": 300, "labels": True, "routes": True},
+    "print": {"size": (1600, 1200), "dpi": 600, "labels": True, "routes": True},
+}
+DEFAULT_PROFILE = "standard"
+
+def get_render_profile(name=None):
+    name = name or DEFAULT_PROFILE
+    if name not in RENDER_PROFILES:
+        raise ValueError(f"unknown render profile {name!r}, expected one of {', '.join(RENDER_PROFILES)}")
+    profile = dict(RENDER_PROFILES[name])
+    # grid-space lengths (padding, hill width, noise period) scale with the grid
+    profile["scale"] = profile["size"][0] / RENDER_PROFILES["standard"]["size"][0]
+    return profile
@@ -1,11 +1,11 @@
-import matplotlib
-matplotlib.use("Agg")  # for ngrok
-import matplotlib.pyplot as plt
+import io
 import numpy as np
-import tempfile
-import os
-from noise import pnoise2
+# A Figure with its own Agg canvas instead of pyplot: no global figure state
+# and no GUI backend, so concurrent requests can render safely.
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.colors import LinearSegmentedColormap
+from src.terrain import gaussian_heightmap, get_render_profile, perlin_noise_grid
 
 colors = [
     (0.0, "#001d4a"),  # deep ocean blue
@@ -30,48 +30,49 @@ def normalized(coords, width, height, pad=40):
         for name, (x, y) in coords.items()
     }
 
-def draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes):
+def draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes, profile=None):
+    """
+    Returns the map as PNG bytes, rendered in memory.
+    profile is a name from terrain.RENDER_PROFILES (preview, standard, print).
+    """
     if not coords:
         return
-    w, h = 800, 600
-    norm_coords = normalized(coords, w, h)
-    terrain = np.zeros((h, w), dtype=float)
-    
-    rr, cc = np.ogrid[:h, :w]
-    for (x, y) in norm_coords.values():
-        dist = np.sqrt((rr - y)**2 + (cc - x)**2)
-        terrain += np.exp(-(dist**2) / (2 * 350**2))
+    settings = get_render_profile(profile)
+    w, h = settings["size"]
+    k = settings["scale"]
+    with_routes = with_routes and settings["routes"]
+    norm_coords = normalized(coords, w, h, pad=40 * k)
+    terrain = gaussian_heightmap(norm_coords.values(), w, h, sigma=350 * k)
     terrain = (terrain - terrain.min()) / (terrain.max() - terrain.min())
     terrain = terrain ** 2.0 
 
     # add noise everywhere:
-    for y in range(h):
-        for x in range(w):
-            terrain[y, x] += 0.2 * pnoise2(x * 0.02, y * 0.02)
+    terrain += 0.2 * perlin_noise_grid(w, h, scale=0.02 / k)
     terrain = np.clip(terrain, 0, 1)
 
-    fig, ax = plt.subplots(figsize=(8, 6))
+    fig = Figure(figsize=(8, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
     ax.imshow(terrain, cmap=world_cmap, origin="lower")
-    for name, (x, y) in norm_coords.items():
-        ax.text(x, y, name, ha="center", va="center", color="black")
+    if settings["labels"]:
+        for name, (x, y) in norm_coords.items():
+            ax.text(x, y, name, ha="center", va="center", color="black")
 
     for (a, b), d in distances.items():
         d = d[0]
         xa, ya = norm_coords[a]
         xb, yb = norm_coords[b]
         if with_routes:
-            plt.plot([xa, xb], [ya, yb], "k--", alpha=0.6)
+            ax.plot([xa, xb], [ya, yb], "k--", alpha=0.6)
             midx, midy = (xa+xb)/2, (ya+yb)/2
-            plt.text(midx, midy, f"{d:.1f}", fontsize=8, color="gray")
+            ax.text(midx, midy, f"{d:.1f}", fontsize=8, color="gray")
 
         s_key = tuple(sorted((a, b)))
         if s_key in conflicts or s_key in direction_conflicts:
-            plt.text(xa+0.6, ya+8, "⚠️", fontsize=16, color="red")
+            ax.text(xa+0.6*k, ya+8*k, "⚠️", fontsize=16, color="red")
                          
     ax.axis("off")
 
-    tmp_dir = tempfile.gettempdir()
-    file_path = os.path.join(tmp_dir, "terrain_map.png")
-    fig.savefig(file_path, dpi=300, bbox_inches="tight")
-    plt.close(fig)
-    return file_path
\ No newline at end of file
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=settings["dpi"], bbox_inches="tight")
+    return buf.getvalue()
@@ -3,8 +3,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import tempfile
 import os
-from noise import pnoise2
 from matplotlib.colors import LinearSegmentedColormap
+from src.terrain import gaussian_heightmap, get_render_profile, perlin_noise_grid
 
 colors = [
     (0.0, "#001d4a"),  # deep ocean blue
@@ -29,30 +29,28 @@ def normalized(coords, width, height, pad=40):
         for name, (x, y) in coords.items()
     }
 
-def draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes):
+def draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes, profile=None):
+    """profile is a name from terrain.RENDER_PROFILES (preview, standard, print)."""
     if not coords:
         return
-    w, h = 800, 600
-    norm_coords = normalized(coords, w, h)
-    terrain = np.zeros((h, w), dtype=float)
-    
-    rr, cc = np.ogrid[:h, :w]
-    for (x, y) in norm_coords.values():
-        dist = np.sqrt((rr - y)**2 + (cc - x)**2)
-        terrain += np.exp(-(dist**2) / (2 * 350**2))
+    settings = get_render_profile(profile)
+    w, h = settings["size"]
+    k = settings["scale"]
+    with_routes = with_routes and settings["routes"]
+    norm_coords = normalized(coords, w, h, pad=40 * k)
+    terrain = gaussian_heightmap(norm_coords.values(), w, h, sigma=350 * k)
     terrain = (terrain - terrain.min()) / (terrain.max() - terrain.min())
     terrain = terrain ** 2.0 
 
     # add noise everywhere:
-    for y in range(h):
-        for x in range(w):
-            terrain[y, x] += 0.2 * pnoise2(x * 0.02, y * 0.02)
+    terrain += 0.2 * perlin_noise_grid(w, h, scale=0.02 / k)
     terrain = np.clip(terrain, 0, 1)
 
     fig, ax = plt.subplots(figsize=(8, 6))
     ax.imshow(terrain, cmap=world_cmap, origin="lower")
-    for name, (x, y) in norm_coords.items():
-        ax.text(x, y, name, ha="center", va="center", color="black")
+    if settings["labels"]:
+        for name, (x, y) in norm_coords.items():
+            ax.text(x, y, name, ha="center", va="center", color="black")
 
     for (a, b), d in distances.items():
         d = d[0]
@@ -65,9 +63,9 @@ def draw_terrain(coords, distances, conflicts, direction_conflicts, with_routes)
 
         s_key = tuple(sorted((a, b)))
         if s_key in conflicts or s_key in direction_conflicts:
-            plt.text(xa+0.6, ya+8, "⚠️", fontsize=16, color="red")
+            plt.text(xa+0.6*k, ya+8*k, "⚠️", fontsize=16, color="red")
                          
     ax.axis("off")
 
-    plt.savefig("map.png", dpi=300, bbox_inches="tight")  # best for submissions or reports
+    plt.savefig("map.png", dpi=settings["dpi"], bbox_inches="tight")  # best for submissions or reports
     return
\ No newline at end of file
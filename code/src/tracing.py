@@ -0,0 +1,112 @@
+# Per-stage timing and memory of the map pipeline, as a JSON log or OpenTelemetry spans.
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class Trace:
+    """
+    Records one entry per pipeline stage (extract, distances, directions,
+    conflicts, solve, render): wall time, CPU time of the calling thread and,
+    with memory=True, the tracemalloc peak, plus sizes the stage attaches:
+
+        with trace.stage("solve") as attributes:
+            ...
+            attributes["locations"] = len(locations)
+
+    memory=True starts tracemalloc, which slows everything down noticeably,
+    and the peak covers the whole process, so leave it off in the server.
+    """
+    def __init__(self, name="generate_map", memory=False):
+        self.name = name
+        self.memory = memory
+        self.start_ns = time.time_ns()
+        self.stages = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, **attributes):
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start_ns, cpu = time.time_ns(), time.thread_time()
+        wall = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            record = {
+                "name": name,
+                "start_ns": start_ns,
+                "end_ns": time.time_ns(),
+                "wall_s": round(time.perf_counter() - wall, 6),
+                "cpu_s": round(time.thread_time() - cpu, 6),
+                "attributes": attributes,
+            }
+            if self.memory:
+                record["peak_bytes"] = tracemalloc.get_traced_memory()[1] - base
+            self.stages.append(record)
+
+    def extend(self, other):
+        """Adds the stages of a trace recorded elsewhere (e.g. in a worker process)."""
+        self.stages += other.stages
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "wall_s": round(sum(s["wall_s"] for s in self.stages), 6),
+            "cpu_s": round(sum(s["cpu_s"] for s in self.stages), 6),
+            "stages": [
+                {key: value for key, value in s.items() if key not in ("start_ns", "end_ns")}
+                | {"start_s": round((s["start_ns"] - self.start_ns) / 1e9, 6)}
+                for s in self.stages
+            ],
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def export_otel(self, tracer=None):
+        """
+        Sends the trace as a span with one child span per stage through
+        OpenTelemetry; where they go is up to the configured tracer provider
+        (nothing is sent without one). Does nothing if opentelemetry isn't installed.
+        """
+        try:
+            from opentelemetry import trace as otel
+        except ImportError:
+            return
+        if not self.stages:
+            return
+        tracer = tracer or otel.get_tracer("story-map")
+        root = tracer.start_span(self.name, start_time=self.stages[0]["start_ns"])
+        context = otel.set_span_in_context(root)
+        for s in self.stages:
+            span = tracer.start_span(s["name"], context=context, start_time=s["start_ns"])
+            span.set_attribute("cpu_s", s["cpu_s"])
+            if "peak_bytes" in s:
+                span.set_attribute("peak_bytes", s["peak_bytes"])
+            for key, value in s["attributes"].items():
+                if isinstance(value, (bool, int, float, str)):
+                    span.set_attribute(key, value)
+            span.end(end_time=s["end_ns"])
+        root.end(end_time=max(s["end_ns"] for s in self.stages))
+
+def console_tracer():
+    """An OpenTelemetry tracer printing spans to stdout (needs opentelemetry-sdk)."""
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter, SimpleSpanProcessor
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+    return provider.get_tracer("story-map")
+
+class NullTrace:
+    """Stands in when nothing is being traced."""
+    @contextmanager
+    def stage(self, name, **attributes):
+        yield attributes
+
+    def extend(self, other):
+        pass
+
+NO_TRACE = NullTrace()